@@ -0,0 +1,385 @@
+"""Импорт истории отчетов из экспорта чата Telegram (result.json).
+
+Экспорт читается потоком, по одному сообщению, и целиком в память не
+загружается. Сообщения проходят ту же расшифровку, разбор и проверку
+повторов, что и в боте, а строки пишутся в таблицу большими пачками.
+Прогресс сохраняется в файл отметки, и прерванный импорт продолжается с
+того же места. Исходные сообщения в Google Drive не архивируются, а
+счетчики сообщений не меняются. Запуск из корня репозитория:
+
+    python backfill.py result.json --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import main
+
+logger = logging.getLogger(__name__)
+
+# Ключ "messages" вне строкового значения (перед кавычкой нет обратной косой черты)
+MESSAGES_RE = re.compile(r'(?<!\\)"messages"\s*:\s*\[')
+CHAT_TYPE_RE = re.compile(r'"type"\s*:\s*"([a-z_]+)"')
+CHAT_ID_RE = re.compile(r'"id"\s*:\s*(-?\d+)')
+HEADER_LIMIT = 64 * 1024  # сколько текста перед массивом сообщений хранится для поиска id и типа чата
+SUPERGROUP_TYPES = {"private_supergroup", "public_supergroup", "private_channel", "public_channel"}
+
+
+def bot_chat_id(chat_type: str, chat_id: int) -> int:
+    """chat.id, под которым чат виден боту, чтобы ключи сообщений совпадали с живой обработкой"""
+    if chat_type in SUPERGROUP_TYPES:
+        return int(f"-100{chat_id}")
+    if chat_type == "private_group":
+        return -chat_id
+    return chat_id
+
+
+class ExportReader:
+    """Потоковое чтение экспорта: сообщения всех массивов "messages" по одному.
+
+    Файл читается частями по chunk_size символов, каждое сообщение разбирается
+    json.JSONDecoder.raw_decode, а прочитанная часть буфера отбрасывается.
+    Подходит и для экспорта одного чата, и для полного экспорта аккаунта.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1 << 20):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chat_id = 0
+        self._decoder = json.JSONDecoder()
+        self._file = None
+        self._buffer = ""
+        self._pos = 0
+
+    def _read(self) -> bool:
+        """Дочитывает часть файла; False - файл закончился"""
+        chunk = self._file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _find_messages(self) -> bool:
+        """Переходит к началу следующего массива сообщений и запоминает его чат"""
+        header = ""
+        while True:
+            match = MESSAGES_RE.search(self._buffer, self._pos)
+            if match is not None:
+                header = (header + self._buffer[self._pos:match.start()])[-HEADER_LIMIT:]
+                self._pos = match.end()
+                break
+            # Ключ может оказаться на границе частей: хвост буфера просматривается еще раз
+            keep = max(self._pos, len(self._buffer) - 32)
+            header = (header + self._buffer[self._pos:keep])[-HEADER_LIMIT:]
+            self._pos = keep
+            if not self._read():
+                return False
+        # Поля чата идут перед его сообщениями; берутся последние из них
+        types, ids = CHAT_TYPE_RE.findall(header), CHAT_ID_RE.findall(header)
+        self.chat_id = bot_chat_id(types[-1] if types else "", int(ids[-1]) if ids else 0)
+        return True
+
+    def _peek(self) -> str:
+        """Следующий значимый символ массива (пробелы и запятые пропускаются); "" - конец файла"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n,":
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._read():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def __iter__(self):
+        """Пары (chat.id, сообщение)"""
+        with open(self.path, encoding="utf-8") as self._file:
+            self._buffer, self._pos = "", 0
+            while self._find_messages():
+                while True:
+                    char = self._peek()
+                    if not char:
+                        raise ValueError("Экспорт обрывается внутри массива сообщений")
+                    if char == "]":
+                        self._pos += 1
+                        break
+                    try:
+                        message, end = self._decoder.raw_decode(self._buffer, self._pos)
+                    except json.JSONDecodeError:
+                        # Сообщение еще не прочитано целиком
+                        if not self._read():
+                            raise
+                        continue
+                    self._pos = end
+                    yield self.chat_id, message
+
+
+def message_text(message: dict) -> str:
+    """Текст сообщения экспорта: строка или список из строк и форматированных фрагментов"""
+    text = message.get("text", "")
+    if isinstance(text, list):
+        text = "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return text
+
+
+class Checkpoint:
+    """Отметка прогресса: сколько сообщений от начала экспорта обработано.
+
+    Сообщения обрабатываются параллельно, поэтому отметка двигается только
+    по непрерывному началу: при продолжении повторно пройдут лишь сообщения,
+    которые были в работе (их строки не задвоятся, см. Outbox). Сообщения,
+    которые не удалось расшифровать, запоминаются и при продолжении
+    обрабатываются снова.
+    """
+
+    def __init__(self, path: str, source: str):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.done = 0
+        self.failed = set()
+        self._finished = set()
+        self._saved_at = 0.0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("source") == self.source:
+                self.done = state["done"]
+                self.failed = set(state.get("failed", []))
+            else:
+                logger.warning(f"Отметка {path} относится к другому экспорту, импорт начнется сначала")
+
+    def should_process(self, index: int, message_key: str) -> bool:
+        return index >= self.done or message_key in self.failed
+
+    def finish(self, index: int, message_key: str, ok: bool = True):
+        if ok:
+            self.failed.discard(message_key)
+        else:
+            self.failed.add(message_key)
+        self.skip(index)
+        if time.monotonic() - self._saved_at > 1.0:
+            self.save()
+
+    def skip(self, index: int):
+        """Отмечает сообщение, которое обрабатывать не нужно"""
+        self._finished.add(index)
+        while self.done in self._finished:
+            self._finished.remove(self.done)
+            self.done += 1
+
+    def save(self):
+        # Атомарная замена: прерывание во время записи не портит отметку
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"source": self.source, "done": self.done, "failed": sorted(self.failed)}, f)
+        os.replace(temporary, self.path)
+        self._saved_at = time.monotonic()
+
+
+@dataclass
+class BackfillStats:
+    """Итоги импорта для отчета о производительности"""
+    read: int = 0
+    imported: int = 0
+    already_imported: int = 0
+    without_numbers: int = 0
+    failed: int = 0
+    rows: int = 0
+    duplicates: int = 0
+    errors: int = 0
+    appends: int = 0
+    rows_written: int = 0
+    undelivered: int = 0
+    parked: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+
+def read_photo(path: str):
+    async def read() -> bytes:
+        def read_file() -> bytes:
+            with open(path, "rb") as f:
+                return f.read()
+        return await asyncio.to_thread(read_file)
+    return read
+
+
+async def import_message(chat_id: int, message: dict, export_dir: str, stats: BackfillStats) -> bool:
+    """Расшифровывает сообщение экспорта и фиксирует его строки; False - повторить при продолжении"""
+    message_key = f"{chat_id}:{message['id']}"
+    if await main.outbox.processed(message_key) is not None:
+        stats.already_imported += 1
+        return True
+
+    text = message_text(message)
+    photo = os.path.join(export_dir, message["photo"]) if message.get("photo") else None
+    if photo is not None and os.path.isfile(photo):
+        result = await main.photo_processor.process(os.path.getsize(photo), read_photo(photo))
+        if not result.ok:
+            logger.error(f"Сообщение {message_key}: {result.error}")
+            stats.failed += 1
+            return False
+        text = "\n".join(part for part in (text, result.text) if part)
+
+    # В строках отчета всегда есть гектары: переписка без чисел в YandexGPT не отправляется
+    if not re.search(r"\d", text):
+        stats.without_numbers += 1
+        return True
+
+    job = main.ReportJob(
+        message=None,
+        text=text,
+        user_id=int(re.sub(r"\D", "", str(message.get("from_id", ""))) or 0),
+        first_name=message.get("from") or "",
+        message_key=message_key,
+        sent_at=datetime.fromisoformat(message["date"])
+    )
+    expansion = await main.expand_report(text)
+    if not expansion.ok:
+        logger.error(f"Сообщение {message_key}: {expansion.error}")
+        stats.failed += 1
+        return False
+    job.lines = [line.strip() for line in expansion.text.split('\n') if line.strip()]
+    await main.stage_parse(job)
+    await main.stage_write(job)
+
+    stats.imported += 1
+    stats.rows += job.successful
+    stats.duplicates += len(job.duplicates)
+    stats.errors += job.errors
+    return True
+
+
+async def backfill(args) -> BackfillStats:
+    stats = BackfillStats()
+    checkpoint = Checkpoint(args.checkpoint or f"{args.export}.checkpoint", args.export)
+    export_dir = os.path.dirname(os.path.abspath(args.export))
+
+    if not await main.startup():
+        raise RuntimeError("Не удалось запустить подсистемы бота")
+    try:
+        if not main.outbox.draining:
+            # Строки из очереди доставлял бы другой процесс, а отчет об импорте был бы неполным
+            raise RuntimeError(
+                f"Очередь записи в {main.DATABASE_FILE} доставляет другой процесс (работающий бот?): "
+                f"остановите его перед импортом"
+            )
+        # Повторы проверяются по строкам, которые уже есть в таблице
+        await main.report_store_task
+        written = main.sheet_sink.on_written
+
+        def on_written(rows: list):
+            stats.appends += 1
+            stats.rows_written += len(rows)
+            written(rows)
+
+        main.sheet_sink.on_written = on_written
+
+        queue = asyncio.Queue(maxsize=args.concurrency * 4)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, chat_id, message = item
+                try:
+                    ok = await import_message(chat_id, message, export_dir, stats)
+                except Exception as e:
+                    logger.error(f"Ошибка импорта сообщения {chat_id}:{message.get('id')}: {str(e)}")
+                    stats.failed += 1
+                    ok = False
+                checkpoint.finish(index, f"{chat_id}:{message.get('id')}", ok)
+
+        workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+        reported = time.perf_counter()
+        for index, (chat_id, message) in enumerate(ExportReader(args.export)):
+            stats.read += 1
+            if message.get("type") != "message" or not checkpoint.should_process(index, f"{chat_id}:{message['id']}"):
+                checkpoint.skip(index)
+                continue
+            await queue.put((index, chat_id, message))
+            if time.perf_counter() - reported > 5:
+                reported = time.perf_counter()
+                elapsed = reported - stats.started
+                print(f"Прочитано {stats.read} сообщений, импортировано {stats.imported} "
+                      f"({stats.imported / elapsed:.1f} сообщ./с), строк {stats.rows}", flush=True)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        checkpoint.save()
+
+        # Ждем, пока очередь записи дойдет до таблицы, но не дольше delivery_timeout без продвижения
+        pending, progressed = main.outbox.pending, time.perf_counter()
+        while main.outbox.pending:
+            if main.outbox.pending < pending:
+                pending, progressed = main.outbox.pending, time.perf_counter()
+            elif time.perf_counter() - progressed > args.delivery_timeout:
+                logger.error(f"Очередь записи не продвигается {args.delivery_timeout:g} с, "
+                             f"в ней осталось {main.outbox.pending} строк")
+                break
+            await asyncio.sleep(0.5)
+        stats.undelivered = main.outbox.pending
+        stats.parked = main.outbox.parked
+    finally:
+        await main.shutdown()
+        checkpoint.save()
+    return stats
+
+
+def format_report(stats: BackfillStats) -> str:
+    elapsed = time.perf_counter() - stats.started
+    cache = main.llm_cache.stats
+    return "\n".join([
+        f"Импорт завершен за {elapsed:.1f} с",
+        f"Сообщений в экспорте: {stats.read}, импортировано: {stats.imported}, "
+        f"уже были импортированы: {stats.already_imported}, без чисел: {stats.without_numbers}, "
+        f"с ошибкой: {stats.failed}",
+        f"Строк записано: {stats.rows} (повторов пропущено: {stats.duplicates}, ошибок разбора: {stats.errors})",
+        f"Не доставлено в таблицу: {stats.undelivered} строк осталось в очереди записи, "
+        f"{stats.parked} отложено после неудачных попыток",
+        f"Скорость: {stats.imported / elapsed:.1f} сообщ./с, {stats.rows / elapsed:.1f} строк/с",
+        f"YandexGPT: запросов {main.token_usage.requests}, токенов {main.token_usage.input_tokens}/"
+        f"{main.token_usage.output_tokens}, доля локального разбора {main.fast_path_stats.hit_rate:.0%}, "
+        f"попаданий в кэш {cache.hit_rate:.0%}",
+        f"Google Sheets: вызовов append_rows {stats.appends}, "
+        f"в среднем {stats.rows_written / max(1, stats.appends):.0f} строк за вызов",
+    ])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Импорт истории отчетов из экспорта чата Telegram")
+    parser.add_argument("export", help="файл result.json экспорта Telegram Desktop")
+    parser.add_argument("--concurrency", type=int, default=16, help="сообщений в обработке одновременно")
+    parser.add_argument("--batch-rows", type=int, default=5000, help="строк в одном вызове append_rows")
+    parser.add_argument("--checkpoint", help="файл отметки прогресса (по умолчанию <export>.checkpoint)")
+    parser.add_argument("--delivery-timeout", type=float, default=600,
+                        help="сколько секунд ждать записи в таблицу, если очередь не продвигается")
+    parser.add_argument("--batching", action=argparse.BooleanOptionalAction, default=True,
+                        help="объединять сообщения в пакетные запросы к YandexGPT")
+    parser.add_argument("--verbose", action="store_true", help="подробный журнал")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None) -> int:
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    main.OUTBOX_BATCH_ROWS = args.batch_rows
+    main.LLM_BATCHING = args.batching
+    main.METRICS_PORT = None
+
+    try:
+        stats = asyncio.run(backfill(args))
+    except RuntimeError as e:
+        print(f"❌ {str(e)}")
+        return 1
+    print(format_report(stats))
+    return 0 if not (stats.failed or stats.undelivered or stats.parked) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
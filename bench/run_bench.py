@@ -0,0 +1,232 @@
+"""Офлайн-замер пропускной способности бота.
+
+Сообщения из корпуса прогоняются через handle_message с заданной частотой,
+а IAM, YandexGPT, Google Sheets и Google Drive заменяются локальным сервером
+(bench/stubs.py). Запуск из корня репозитория:
+
+    python -m bench.run_bench --messages 500 --rate 50 --llm-latency 0.5
+    python -m bench.run_bench --save-baseline bench/baseline.json
+    python -m bench.run_bench --compare bench/baseline.json
+    python -m bench.run_bench --photos 0.3
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import types
+
+import main
+from bench.stubs import StubGoogleServices, StubServer, synthetic_photo
+
+CORPUS_FILE = os.path.join(os.path.dirname(__file__), "corpus.txt")
+
+
+def load_corpus(path: str) -> list:
+    """Сообщения корпуса разделены строкой '---'"""
+    with open(path, encoding="utf-8") as f:
+        messages = [block.strip() for block in f.read().split("\n---\n")]
+    return [message for message in messages if message]
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(share * (len(values) - 1))))
+    return values[index]
+
+
+def fake_message(number: int, text: str, photo: bytes = None):
+    """Объект с полями aiogram Message, которые использует бот; с photo - сообщение с фото"""
+    async def answer(*args, **kwargs):
+        return None
+
+    async def download(file, destination):
+        # Частями, как при потоковой загрузке с серверов Telegram
+        for start in range(0, len(photo), 65536):
+            destination.write(photo[start:start + 65536])
+            await asyncio.sleep(0)
+        return destination
+
+    user_id = 1000 + number % 20
+    return types.SimpleNamespace(
+        message_id=number,
+        text=None if photo else text,
+        caption=None,
+        photo=[types.SimpleNamespace(file_id=f"photo-{number}", file_size=len(photo))] if photo else None,
+        bot=types.SimpleNamespace(download=download),
+        chat=types.SimpleNamespace(id=-100 - number % 5),
+        from_user=types.SimpleNamespace(id=user_id, first_name=f"Агроном{user_id}"),
+        answer=answer,
+    )
+
+
+async def run(args) -> dict:
+    server = StubServer(llm_latency=args.llm_latency)
+    await server.start()
+    workdir = tempfile.mkdtemp(prefix="agro_bench_")
+
+    main.IAM_URL = f"{server.base_url}/iam/v1/tokens"
+    main.COMPLETION_URL = f"{server.base_url}/foundationModels/v1/completion"
+    main.OCR_URL = f"{server.base_url}/ocr/v1/recognizeText"
+    main.DATABASE_FILE = os.path.join(workdir, "bench.db")
+    main.COUNTERS_FILE = os.path.join(workdir, "counters.txt")
+    main.LLM_BATCHING = args.batching
+    main.LLM_STREAMING = args.streaming
+    main.LLM_ROUTING = args.routing
+    main.METRICS_PORT = None
+    main.google = StubGoogleServices(server.base_url)
+
+    # Время завершения фиксируется на последнем этапе, который прошло сообщение
+    started = {}
+    finished = {}
+    original_expand = main.stage_expand
+    original_archive = main.stage_archive
+
+    async def stage_expand(job):
+        result = await original_expand(job)
+        if result is None:
+            finished[id(job.message)] = time.perf_counter()
+        return result
+
+    async def stage_archive(job):
+        result = await original_archive(job)
+        finished[id(job.message)] = time.perf_counter()
+        return result
+
+    main.stage_expand = stage_expand
+    main.stage_archive = stage_archive
+
+    corpus = load_corpus(args.corpus)
+    photo = synthetic_photo() if args.photos else None
+    messages = []
+    for number in range(args.messages):
+        text = corpus[number % len(corpus)]
+        if args.unique:
+            # Уникальная строка не разбирается локально и не попадает в кэш
+            text += f"\nОтчет {number}"
+        # Фото равномерно распределены по потоку сообщений
+        is_photo = int((number + 1) * args.photos) > int(number * args.photos)
+        messages.append(fake_message(number, text, photo if is_photo else None))
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if not await main.startup():
+                raise RuntimeError("Бот не запустился на заменителях API")
+
+            begin = time.perf_counter()
+            for number, message in enumerate(messages):
+                scheduled = begin + number / args.rate
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+                # Задержка считается от запланированного времени отправки
+                started[id(message)] = scheduled
+                if message.photo:
+                    await main.handle_photo(message)
+                else:
+                    await main.handle_message(message)
+
+            deadline = time.perf_counter() + args.timeout
+            while len(finished) < len(messages) and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            end = time.perf_counter()
+            await main.shutdown()
+    finally:
+        main.stage_expand = original_expand
+        main.stage_archive = original_archive
+        await server.stop()
+
+    latencies = [finished[key] - started[key] for key in finished if key in started]
+    return {
+        "messages": len(messages),
+        "completed": len(latencies),
+        "duration_s": round(end - begin, 3),
+        "throughput_msg_s": round(len(latencies) / (end - begin), 2) if end > begin else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99": round(percentile(latencies, 0.99) * 1000, 1),
+        },
+        "api_calls": dict(server.calls),
+        "sheet_rows": len(server.sheet_rows),
+        "fast_path_hit_rate": round(main.fast_path_stats.hit_rate, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "settings": {
+            "rate": args.rate,
+            "llm_latency": args.llm_latency,
+            "batching": args.batching,
+            "streaming": args.streaming,
+            "routing": args.routing,
+            "unique": args.unique,
+            "photos": args.photos,
+        },
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Список регрессий относительно сохраненного замера"""
+    problems = []
+    if report["throughput_msg_s"] < baseline["throughput_msg_s"] * (1 - tolerance):
+        problems.append(
+            f"пропускная способность {report['throughput_msg_s']} < {baseline['throughput_msg_s']} сообщ./с"
+        )
+    for key in ("p95", "p99"):
+        if report["latency_ms"][key] > baseline["latency_ms"][key] * (1 + tolerance):
+            problems.append(
+                f"задержка {key} {report['latency_ms'][key]} > {baseline['latency_ms'][key]} мс"
+            )
+    if report["completed"] < report["messages"]:
+        problems.append(f"обработано {report['completed']} из {report['messages']} сообщений")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-замер пропускной способности бота")
+    parser.add_argument("--messages", type=int, default=200, help="число сообщений")
+    parser.add_argument("--rate", type=float, default=20, help="сообщений в секунду")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="задержка ответа YandexGPT, с")
+    parser.add_argument("--corpus", default=CORPUS_FILE, help="файл корпуса сообщений")
+    parser.add_argument("--unique", action="store_true", help="делать сообщения уникальными (без кэша и локального разбора)")
+    parser.add_argument("--batching", action="store_true", help="включить пакетные запросы к YandexGPT")
+    parser.add_argument("--routing", action=argparse.BooleanOptionalAction, default=True,
+                        help="отправлять короткие сообщения в YandexGPT Lite")
+    parser.add_argument("--streaming", action="store_true", help="включить потоковые ответы YandexGPT")
+    parser.add_argument("--photos", type=float, default=0.0, help="доля сообщений с фото таблицы")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать завершения обработки, с")
+    parser.add_argument("--save-baseline", metavar="PATH", help="сохранить замер как базовый")
+    parser.add_argument("--compare", metavar="PATH", help="сравнить с базовым замером")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="допустимое ухудшение, доля")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Базовый замер сохранен в {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(report, baseline, args.tolerance)
+        if problems:
+            print("Регрессия производительности:\n" + "\n".join(problems))
+            return 1
+        print("Регрессий относительно базового замера нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
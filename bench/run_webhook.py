@@ -0,0 +1,164 @@
+"""Офлайн-замер режима вебхука с несколькими процессами-обработчиками.
+
+Сообщения корпуса отправляются на вебхук бота через TelegramSender, внешние API
+заменяются локальным сервером (bench/stubs.py). Запуск из корня репозитория:
+
+    python -m bench.run_webhook --workers 4 --messages 500 --chats 20
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+import main
+from bench.run_bench import CORPUS_FILE, load_corpus
+from bench.stubs import StubGoogleServices, StubServer, TelegramSender
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def progress(db_path: str) -> tuple:
+    """Число обработанных сообщений и недоставленных в таблицу строк"""
+    with contextlib.closing(sqlite3.connect(db_path, timeout=5)) as db:
+        try:
+            processed = db.execute("SELECT COUNT(*) FROM processed_messages").fetchone()[0]
+            pending = db.execute("SELECT COUNT(*) FROM sheet_outbox WHERE delivered = 0").fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0, 0
+    return processed, pending
+
+
+async def webhook_ready(url: str) -> bool:
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url):
+                return True
+    except aiohttp.ClientError:
+        return False
+
+
+async def run(args) -> dict:
+    server = StubServer(llm_latency=args.llm_latency)
+    await server.start()
+    workdir = tempfile.mkdtemp(prefix="agro_webhook_")
+    port = free_port()
+
+    # Те же настройки получают процессы-обработчики
+    overrides = {
+        "IAM_URL": f"{server.base_url}/iam/v1/tokens",
+        "COMPLETION_URL": f"{server.base_url}/foundationModels/v1/completion",
+        "DATABASE_FILE": os.path.join(workdir, "bench.db"),
+        "COUNTERS_FILE": os.path.join(workdir, "counters.txt"),
+        "METRICS_PORT": None,
+        # Токен нужен только для проверки формата: в Telegram бот на заменителях не обращается
+        "TELEGRAM_TOKEN": "123456789:stub-token-for-offline-benchmarks",
+        "google": StubGoogleServices(server.base_url),
+    }
+    for name, value in overrides.items():
+        setattr(main, name, value)
+    main.WEBHOOK_WORKERS = args.workers
+    main.WEBHOOK_HOST = "127.0.0.1"
+    main.WEBHOOK_PORT = port
+    main.WEBHOOK_URL = None
+
+    corpus = load_corpus(args.corpus)
+    stop = asyncio.Event()
+    bot = asyncio.create_task(main.run_webhook(overrides, stop))
+    webhook_url = f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}"
+
+    try:
+        # Каждый процесс-обработчик при готовности получает свой IAM-токен
+        deadline = time.perf_counter() + 60
+        while server.calls["iam"] < args.workers or not await webhook_ready(webhook_url):
+            if time.perf_counter() > deadline:
+                raise RuntimeError("Вебхук или процессы-обработчики не запустились")
+            await asyncio.sleep(0.2)
+
+        async with TelegramSender(webhook_url) as sender:
+
+            begin = time.perf_counter()
+            rejected = 0
+            for number in range(args.messages):
+                scheduled = begin + number / args.rate
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+                text = corpus[number % len(corpus)] + f"\nОтчет {number}"
+                status = await sender.send_message(-100 - number % args.chats, 1000 + number % 20, text)
+                rejected += status != 200
+
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline:
+            processed, pending = await asyncio.to_thread(progress, overrides["DATABASE_FILE"])
+            if processed >= args.messages - rejected and not pending:
+                break
+            await asyncio.sleep(0.2)
+        end = time.perf_counter()
+    finally:
+        stop.set()
+        await bot
+        await server.stop()
+
+    return {
+        "messages": args.messages,
+        "rejected": rejected,
+        "processed": processed,
+        "duration_s": round(end - begin, 3),
+        "throughput_msg_s": round(processed / (end - begin), 2) if end > begin else 0.0,
+        "api_calls": dict(server.calls),
+        "sheet_rows": len(server.sheet_rows),
+        "settings": {
+            "workers": args.workers,
+            "chats": args.chats,
+            "rate": args.rate,
+            "llm_latency": args.llm_latency,
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-замер режима вебхука")
+    parser.add_argument("--workers", type=int, default=4, help="процессов-обработчиков")
+    parser.add_argument("--messages", type=int, default=200, help="число сообщений")
+    parser.add_argument("--chats", type=int, default=20, help="число чатов")
+    parser.add_argument("--rate", type=float, default=50, help="сообщений в секунду")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="задержка ответа YandexGPT, с")
+    parser.add_argument("--corpus", default=CORPUS_FILE, help="файл корпуса сообщений")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать завершения обработки, с")
+    parser.add_argument("--verbose", action="store_true", help="не скрывать вывод процессов-обработчиков")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.verbose:
+        report = asyncio.run(run(args))
+    else:
+        # Процессы-обработчики наследуют дескрипторы вывода, поэтому заменяем сами дескрипторы
+        saved = os.dup(1), os.dup(2)
+        with open(os.devnull, "w") as devnull:
+            os.dup2(devnull.fileno(), 1)
+            os.dup2(devnull.fileno(), 2)
+            try:
+                report = asyncio.run(run(args))
+            finally:
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0 if report["processed"] + report["rejected"] >= report["messages"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
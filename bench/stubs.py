@@ -0,0 +1,272 @@
+"""Локальные заменители внешних API для офлайн-замеров.
+
+Один aiohttp-сервер отвечает на запросы IAM, YandexGPT (foundationModels
+completion), Yandex Vision OCR, добавления строк в Google Sheets и загрузки
+в Google Drive. synthetic_photo() рисует фото таблицы отчета для замеров
+с фото.
+Клиенты Sheets и Drive для бота заменяются объектами с тем же интерфейсом,
+которые ходят на этот сервер по HTTP. TelegramSender отправляет на вебхук
+бота обновления в формате Telegram Bot API.
+"""
+import asyncio
+import io
+import itertools
+import json
+import random
+import re
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+from aiohttp import web
+from PIL import Image, ImageDraw, ImageFilter
+
+CANNED_LINE = "00.00.00; АОР; Пахота; Соя товарная; 10; 100"
+# Текст, который заменитель OCR "распознает" на любом фото
+OCR_TEXT = "Восход\nСев под сою 53/1816\nПахота под кукурузу 131/448"
+SEPARATOR_RE = re.compile(r"^\s*###\s*(\d+)\s*$", re.MULTILINE)
+
+
+def canned_completion(text: str) -> str:
+    """Готовый ответ модели: по строке отчета на каждую строку ввода с числами"""
+    def answer(block: str) -> str:
+        lines = [CANNED_LINE for line in block.split("\n") if re.search(r"\d", line)]
+        return "\n".join(lines or [CANNED_LINE])
+
+    matches = list(SEPARATOR_RE.finditer(text))
+    if not matches:
+        return answer(text)
+
+    blocks = []
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        blocks.append(f"### {match.group(1)}\n{answer(text[match.end():end])}")
+    return "\n".join(blocks)
+
+
+def synthetic_photo(width: int = 1600, height: int = 1200, seed: int = 0) -> bytes:
+    """JPEG с таблицей отчета на неравномерном фоне, похожий на снимок с телефона"""
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((width, height)).point(lambda value: 150 + value // 3)
+    draw = ImageDraw.Draw(image)
+    for row in range(12):
+        top = 80 + row * 80
+        draw.line((60, top, width - 60, top), fill=40, width=3)
+        for column, text in enumerate(OCR_TEXT.split("\n")):
+            draw.text((80 + column * 480, top + 20), f"{text} {rng.randint(1, 500)}", fill=20)
+    image = image.filter(ImageFilter.GaussianBlur(1)).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+class StubServer:
+    """Заменитель IAM, YandexGPT, OCR, Sheets и Drive с настраиваемой задержкой модели"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, llm_latency: float = 0.5,
+                 token_ttl: float = 12 * 3600, ocr_latency: float = 0.3, lite_latency_share: float = 0.4):
+        self.host = host
+        self.port = port
+        self.llm_latency = llm_latency
+        # YandexGPT Lite отвечает быстрее полной модели
+        self.lite_latency_share = lite_latency_share
+        self.ocr_latency = ocr_latency
+        self.token_ttl = token_ttl
+        self.calls = Counter()
+        self.sheet_rows = []
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/iam/v1/tokens", self._iam)
+        app.router.add_post("/foundationModels/v1/completion", self._completion)
+        app.router.add_post("/ocr/v1/recognizeText", self._ocr)
+        app.router.add_post("/sheets/append", self._sheets_append)
+        app.router.add_post("/drive/upload", self._drive_upload)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _iam(self, request):
+        self.calls["iam"] += 1
+        expires = datetime.now(timezone.utc) + timedelta(seconds=self.token_ttl)
+        return web.json_response({
+            "iamToken": f"stub-token-{self.calls['iam']}",
+            "expiresAt": expires.isoformat().replace("+00:00", "Z")
+        })
+
+    async def _completion(self, request):
+        payload = await request.json()
+        lite = payload.get("modelUri", "").endswith("/yandexgpt-lite")
+        self.calls["completion_lite" if lite else "completion"] += 1
+        latency = self.llm_latency * (self.lite_latency_share if lite else 1)
+        messages = payload.get("messages", [])
+        system_text = messages[0]["text"] if messages else ""
+        user_text = messages[-1]["text"] if messages else ""
+        text = canned_completion(user_text)
+
+        def chunk(partial: str, status: str) -> dict:
+            return {"result": {
+                "alternatives": [{"message": {"role": "assistant", "text": partial}, "status": status}],
+                "usage": {
+                    "inputTextTokens": str((len(system_text) + len(user_text)) // 3),
+                    "completionTokens": str(len(partial) // 3),
+                    "totalTokens": str((len(system_text) + len(user_text) + len(partial)) // 3)
+                },
+                "modelVersion": "stub"
+            }}
+
+        if not payload.get("completionOptions", {}).get("stream"):
+            await asyncio.sleep(latency)
+            return web.json_response(chunk(text, "ALTERNATIVE_STATUS_FINAL"))
+
+        # Потоковый ответ: строки генерируются равномерно за llm_latency, каждая часть - весь текст с начала
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        lines = text.split("\n")
+        for count in range(1, len(lines) + 1):
+            await asyncio.sleep(latency / len(lines))
+            status = "ALTERNATIVE_STATUS_FINAL" if count == len(lines) else "ALTERNATIVE_STATUS_PARTIAL"
+            data = json.dumps(chunk("\n".join(lines[:count]), status), ensure_ascii=False)
+            await response.write(data.encode("utf-8") + b"\n")
+        await response.write_eof()
+        return response
+
+    async def _ocr(self, request):
+        self.calls["ocr"] += 1
+        payload = await request.json()
+        if not payload.get("content"):
+            return web.json_response({"message": "content is required"}, status=400)
+        await asyncio.sleep(self.ocr_latency)
+        return web.json_response({"result": {"textAnnotation": {"fullText": OCR_TEXT}, "page": "0"}})
+
+    async def _sheets_append(self, request):
+        self.calls["sheets_append"] += 1
+        rows = await request.json()
+        self.sheet_rows.extend(rows)
+        return web.json_response({"updates": {"updatedRows": len(rows)}})
+
+    async def _drive_upload(self, request):
+        self.calls["drive_upload"] += 1
+        await request.read()
+        return web.json_response({"id": f"stub-file-{self.calls['drive_upload']}"})
+
+
+def _post(url: str, payload) -> dict:
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+class StubWorksheet:
+    """Лист таблицы, который добавляет строки через заменитель Sheets API"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    def append_rows(self, rows: list):
+        return _post(f"{self.base_url}/sheets/append", rows)
+
+    def get_all_values(self) -> list:
+        return []
+
+
+class _StubRequest:
+    def __init__(self, base_url: str, body: dict):
+        self.base_url = base_url
+        self.body = body
+
+    def execute(self, http=None):
+        return _post(f"{self.base_url}/drive/upload", self.body)
+
+
+class _StubFiles:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    def create(self, body=None, media_body=None, fields=None):
+        return _StubRequest(self.base_url, body or {})
+
+
+class StubDrive:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    def files(self):
+        return _StubFiles(self.base_url)
+
+
+class StubCredentials:
+    def authorize(self, http):
+        return http
+
+
+class StubGoogleServices:
+    """Замена GoogleServices с тем же интерфейсом"""
+
+    def __init__(self, base_url: str):
+        self._worksheet = StubWorksheet(base_url)
+        self._drive = StubDrive(base_url)
+        self.credentials = StubCredentials()
+
+    def worksheet(self):
+        return self._worksheet
+
+    def drive(self):
+        return self._drive
+
+
+class TelegramSender:
+    """Отправитель обновлений Telegram на вебхук бота (вместо серверов Telegram)"""
+
+    def __init__(self, webhook_url: str, secret: str = None):
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    def message_update(self, chat_id: int, user_id: int, text: str, first_name: str = None) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group", "title": f"Чат {chat_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": first_name or f"Агроном{user_id}"},
+                "text": text,
+            },
+        }
+
+    async def send_update(self, update: dict) -> int:
+        """Отправляет обновление и возвращает HTTP-статус ответа вебхука"""
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        async with self._session.post(self.webhook_url, json=update, headers=headers) as response:
+            return response.status
+
+    async def send_message(self, chat_id: int, user_id: int, text: str, first_name: str = None) -> int:
+        return await self.send_update(self.message_update(chat_id, user_id, text, first_name))
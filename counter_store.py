@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class CounterStore:
+    """Счетчики сообщений пользователей в таблице SQLite.
+
+    Значение пользователя загружается при первом обращении и дальше меняется
+    в памяти; изменения записываются пачкой раз в flush_interval секунд одной
+    транзакцией, поэтому сбой процесса не может повредить файл счетчиков.
+
+    shared - с базой работают несколько процессов: значения не держатся
+    в памяти, а каждое изменение сразу выполняется отдельной транзакцией.
+    """
+
+    def __init__(self, db_path: str, legacy_file: str = None, flush_interval: float = 0.5,
+                 shared: bool = False):
+        self.db_path = db_path
+        self.legacy_file = legacy_file
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._lock = asyncio.Lock()
+        self._values = {}
+        self._loading = {}
+        self._dirty = set()
+        self._db = None
+        self._task = None
+
+    async def open(self):
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS message_counters ("
+            "user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL)"
+        )
+        await self._db.commit()
+        await self._import_legacy_file()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            await self._db.close()
+            self._db = None
+
+    async def get(self, user_id: int) -> int:
+        if self.shared:
+            return await self._load(user_id)
+        if user_id in self._values:
+            return self._values[user_id]
+
+        # Одновременные обращения к новому пользователю ждут одну загрузку
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = loading
+        try:
+            value = await loading
+        finally:
+            self._loading.pop(user_id, None)
+        return self._values.setdefault(user_id, value)
+
+    async def add(self, user_id: int, delta: int) -> int:
+        """Атомарно меняет счетчик пользователя и возвращает новое значение"""
+        if self.shared:
+            # Запись и чтение в одной транзакции: другие процессы не вклинятся между ними
+            async with self._lock:
+                await self._db.execute(
+                    "INSERT INTO message_counters (user_id, count) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count",
+                    (user_id, delta)
+                )
+                value = await self._load(user_id)
+                await self._db.commit()
+            return value
+        value = await self.get(user_id) + delta
+        self._values[user_id] = value
+        self._dirty.add(user_id)
+        return value
+
+    async def increment(self, user_id: int) -> int:
+        return await self.add(user_id, 1)
+
+    async def decrement(self, user_id: int) -> int:
+        return await self.add(user_id, -1)
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty or self._db is None:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [(user_id, self._values[user_id]) for user_id in dirty]
+        try:
+            await self._db.executemany(
+                "INSERT INTO message_counters (user_id, count) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET count = excluded.count",
+                rows
+            )
+            await self._db.commit()
+        except Exception as e:
+            self._dirty |= dirty
+            logger.error(f"Ошибка сохранения счетчиков: {str(e)}")
+
+    async def _load(self, user_id: int) -> int:
+        async with self._db.execute(
+            "SELECT count FROM message_counters WHERE user_id = ?", (user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _import_legacy_file(self):
+        """Однократно переносит счетчики из старого counters.txt, если таблица пуста"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        async with self._db.execute("SELECT COUNT(*) FROM message_counters") as cursor:
+            (existing,) = await cursor.fetchone()
+        if existing:
+            return
+
+        rows = []
+        with open(self.legacy_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    user_id, count = line.strip().split(',')
+                    rows.append((int(user_id), int(count)))
+                except ValueError:
+                    logger.warning(f"Некорректная строка в файле счетчика: {line}")
+
+        await self._db.executemany(
+            "INSERT OR IGNORE INTO message_counters (user_id, count) VALUES (?, ?)", rows
+        )
+        await self._db.commit()
+        logger.info(f"Перенесено счетчиков из {self.legacy_file}: {len(rows)}")
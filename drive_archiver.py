@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+import aiosqlite
+import httplib2
+from googleapiclient.http import MediaIoBaseUpload
+
+from metrics import DRIVE_UPLOAD_SECONDS
+from rate_limiter import is_quota_error
+
+logger = logging.getLogger(__name__)
+
+DOC_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+@dataclass
+class ArchiveJob:
+    """Исходный текст отчета, который нужно сохранить в Google Drive"""
+    filename: str
+    content: str
+    folder_id: str
+    job_id: Optional[int] = None
+    attempts: int = 0
+
+
+class DriveArchiver:
+    """Фоновая архивация отчетов в Google Drive.
+
+    Задания попадают в очередь и сразу записываются в таблицу SQLite, поэтому
+    ответ пользователю не ждет загрузки, а незавершенные задания переживают
+    перезапуск. Загрузка выполняется в ограниченном пуле потоков одним
+    multipart-запросом; клиент Drive создается при первой загрузке через
+    get_drive. Неудачные задания повторяются с растущей задержкой.
+
+    Задание в работе закреплено за процессом (owner) до lease_until; аренда
+    продлевается, пока задание ждет в очереди или загружается. Другие процессы
+    с той же базой забирают только задания без действующей аренды.
+    """
+
+    def __init__(self, get_drive, get_credentials, db_path: str,
+                 workers: int = 4, max_queue: int = 1000,
+                 retry_interval: float = 60, max_attempts: int = 10, limiter=None,
+                 lease_interval: float = 120):
+        self.get_drive = get_drive
+        self.get_credentials = get_credentials
+        self.db_path = db_path
+        self.workers = workers
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.limiter = limiter
+        self.lease_interval = lease_interval
+        self.owner = uuid.uuid4().hex
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._executor = None
+        self._db = None
+        self._tasks = []
+        self._pending = set()
+        self._local = threading.local()
+
+    async def start(self):
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS drive_queue ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL, "
+            "content TEXT NOT NULL, folder_id TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL DEFAULT 0, "
+            "owner TEXT, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+        async with self._db.execute("PRAGMA table_info(drive_queue)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        # База, созданная до аренды заданий
+        if "owner" not in columns:
+            await self._db.execute("ALTER TABLE drive_queue ADD COLUMN owner TEXT")
+        if "lease_until" not in columns:
+            await self._db.execute("ALTER TABLE drive_queue ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+        await self._db.commit()
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="drive")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._retry_loop()))
+        self._tasks.append(asyncio.create_task(self._lease_loop()))
+
+    async def stop(self, timeout: float = 30):
+        """Дожидается загрузки очереди (не дольше timeout) и останавливает воркеры"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Архивация не завершена, в очереди осталось {self._queue.qsize()} файлов")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._db is not None:
+            # Незагруженные задания сразу доступны другим процессам
+            try:
+                await self._db.execute(
+                    "UPDATE drive_queue SET owner = NULL, lease_until = 0 WHERE owner = ?", (self.owner,)
+                )
+                await self._db.commit()
+            except Exception as e:
+                logger.error(f"Ошибка освобождения заданий архивации: {str(e)}")
+            await self._db.close()
+            self._db = None
+
+    @property
+    def pending(self) -> int:
+        """Число файлов в очереди загрузки"""
+        return self._queue.qsize()
+
+    def submit(self, content: str, filename: str, folder_id: str):
+        """Ставит файл в очередь архивации и сразу возвращает управление"""
+        job = ArchiveJob(filename=filename, content=content, folder_id=folder_id)
+        task = asyncio.create_task(self._enqueue(job))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _enqueue(self, job: ArchiveJob):
+        # Сначала сохраняем задание на диск, чтобы оно пережило перезапуск.
+        # Задание сразу закреплено за этим процессом: другие его не заберут, пока действует аренда
+        try:
+            now = time.time()
+            cursor = await self._db.execute(
+                "INSERT INTO drive_queue (filename, content, folder_id, next_attempt, owner, lease_until) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job.filename, job.content, job.folder_id, now, self.owner, now + self.lease_interval)
+            )
+            await self._db.commit()
+            job.job_id = cursor.lastrowid
+        except Exception as e:
+            logger.error(f"Ошибка сохранения задания архивации: {str(e)}")
+
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # Задание осталось в таблице, его подберет цикл повторов
+            logger.warning(f"Очередь архивации переполнена, {job.filename} будет загружен позже")
+            try:
+                await self._defer(job, 0)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения задания архивации: {str(e)}")
+
+    def _thread_http(self):
+        """Отдельный HTTP-клиент на поток: httplib2 не потокобезопасен"""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self.get_credentials().authorize(httplib2.Http(timeout=30))
+            self._local.http = http
+        return http
+
+    def _upload(self, job: ArchiveJob):
+        file_metadata = {
+            'name': job.filename,
+            'parents': [job.folder_id],
+            'mimeType': DOC_MIME_TYPE
+        }
+        # Небольшой текст отправляем одним multipart-запросом без resumable-сессии
+        media = MediaIoBaseUpload(BytesIO(job.content.encode('utf-8')),
+                                  mimetype='text/plain',
+                                  resumable=False)
+        self.get_drive().files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id'
+        ).execute(http=self._thread_http())
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                async with (self.limiter.slot() if self.limiter is not None else nullcontext({})) as state:
+                    started = time.perf_counter()
+                    try:
+                        await loop.run_in_executor(self._executor, self._upload, job)
+                        uploaded = True
+                    except Exception as e:
+                        uploaded = False
+                        state["throttled"] = is_quota_error(e)
+                        logger.error(f"Ошибка сохранения в Google Drive ({job.filename}): {str(e)}")
+                    DRIVE_UPLOAD_SECONDS.observe(time.perf_counter() - started, result="ok" if uploaded else "error")
+                if uploaded:
+                    await self._mark_done(job)
+                elif state["throttled"]:
+                    # Превышение квоты не считается неудачной попыткой
+                    await self._defer(job, self.retry_interval)
+                else:
+                    await self._mark_failed(job)
+            except Exception as e:
+                logger.error(f"Ошибка очереди архивации ({job.filename}): {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def _mark_done(self, job: ArchiveJob):
+        if job.job_id is None:
+            return
+        await self._db.execute("DELETE FROM drive_queue WHERE id = ?", (job.job_id,))
+        await self._db.commit()
+
+    async def _defer(self, job: ArchiveJob, delay: float):
+        if job.job_id is None:
+            return
+        await self._db.execute(
+            "UPDATE drive_queue SET next_attempt = ?, owner = NULL, lease_until = 0 WHERE id = ?",
+            (time.time() + delay, job.job_id)
+        )
+        await self._db.commit()
+
+    async def _mark_failed(self, job: ArchiveJob):
+        if job.job_id is None:
+            return
+        job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            logger.error(f"Файл {job.filename} не загружен после {job.attempts} попыток, задание удалено")
+            await self._mark_done(job)
+            return
+        delay = min(self.retry_interval * 2 ** (job.attempts - 1), 3600)
+        await self._db.execute(
+            "UPDATE drive_queue SET attempts = ?, next_attempt = ?, owner = NULL, lease_until = 0 WHERE id = ?",
+            (job.attempts, time.time() + delay, job.job_id)
+        )
+        await self._db.commit()
+
+    async def _retry_loop(self):
+        """Периодически возвращает в очередь задания, которые пора повторить"""
+        while True:
+            try:
+                now = time.time()
+                async with self._db.execute(
+                    "SELECT id, filename, content, folder_id, attempts FROM drive_queue "
+                    "WHERE next_attempt <= ? AND lease_until <= ? ORDER BY id", (now, now)
+                ) as cursor:
+                    rows = await cursor.fetchall()
+                for job_id, filename, content, folder_id, attempts in rows:
+                    if self._queue.full():
+                        break
+                    # Задание забирается атомарным взятием аренды: если с базой работают
+                    # несколько процессов, один и тот же файл загрузит только один из них
+                    now = time.time()
+                    cursor = await self._db.execute(
+                        "UPDATE drive_queue SET owner = ?, lease_until = ? "
+                        "WHERE id = ? AND next_attempt <= ? AND lease_until <= ?",
+                        (self.owner, now + self.lease_interval, job_id, now, now)
+                    )
+                    await self._db.commit()
+                    if cursor.rowcount != 1:
+                        continue
+                    self._queue.put_nowait(ArchiveJob(filename, content, folder_id, job_id, attempts))
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди архивации: {str(e)}")
+            await asyncio.sleep(self.retry_interval)
+
+    async def _lease_loop(self):
+        """Продлевает аренду заданий этого процесса, пока они ждут в очереди или загружаются"""
+        while True:
+            await asyncio.sleep(self.lease_interval / 3)
+            try:
+                await self._db.execute(
+                    "UPDATE drive_queue SET lease_until = ? WHERE owner = ?",
+                    (time.time() + self.lease_interval, self.owner)
+                )
+                await self._db.commit()
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды заданий архивации: {str(e)}")
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import math
+from datetime import date
+from typing import Optional
+
+from report_store import parse_day, parse_hectares
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_text(value: str) -> str:
+    return " ".join(str(value).split()).casefold()
+
+
+def _normalize_hectares(value: str) -> str:
+    hectares = parse_hectares(value)
+    return "" if math.isnan(hectares) else f"{hectares:g}"
+
+
+def row_fingerprint(row: list) -> Optional[tuple]:
+    """(день, хеш строки) для строки [дата, участок, операция, культура, за день, всего];
+    None - если строку нельзя сравнивать (неполная или без даты)"""
+    if len(row) < 6:
+        return None
+    day = parse_day(row[0])
+    if day < 0:
+        return None
+    # Регистр, лишние пробелы и запись гектаров ("12,5" и "12.5") на сравнение не влияют
+    key = "\x1f".join(
+        [_normalize_text(value) for value in row[1:4]] + [_normalize_hectares(value) for value in row[4:6]]
+    )
+    return day, int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class DuplicateIndex:
+    """Хеши уже записанных в таблицу строк, сгруппированные по дате отчета.
+
+    Хранится по 8 байт хеша на строку. С max_days хранятся только строки за
+    последние max_days дней: более старые не индексируются и не проверяются.
+    """
+
+    def __init__(self, max_days: Optional[int] = None):
+        self.max_days = max_days
+        self._days = {}
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _cutoff(self) -> int:
+        return date.today().toordinal() - self.max_days if self.max_days is not None else -1
+
+    def contains(self, row: list) -> bool:
+        fingerprint = row_fingerprint(row)
+        if fingerprint is None:
+            return False
+        day, digest = fingerprint
+        return digest in self._days.get(day, ())
+
+    def add(self, row: list) -> bool:
+        """Добавляет строку; False - если такая строка уже есть"""
+        fingerprint = row_fingerprint(row)
+        if fingerprint is None:
+            return True
+        day, digest = fingerprint
+        if day < self._cutoff():
+            return True
+        digests = self._days.get(day)
+        if digests is None:
+            digests = self._days[day] = set()
+            self.prune()
+        if digest in digests:
+            return False
+        digests.add(digest)
+        self.size += 1
+        return True
+
+    def discard(self, row: list):
+        """Убирает строку, которую так и не удалось зафиксировать"""
+        fingerprint = row_fingerprint(row)
+        if fingerprint is None:
+            return
+        day, digest = fingerprint
+        digests = self._days.get(day)
+        if digests is not None and digest in digests:
+            digests.remove(digest)
+            self.size -= 1
+
+    def add_rows(self, rows: list):
+        for row in rows:
+            self.add(row)
+
+    def merge(self, other: "DuplicateIndex"):
+        """Добавляет строки другого индекса (например, построенного из таблицы в отдельном потоке)"""
+        for day, digests in other._days.items():
+            own = self._days.setdefault(day, set())
+            self.size -= len(own)
+            own |= digests
+            self.size += len(own)
+        self.prune()
+
+    def prune(self):
+        """Забывает дни старше max_days"""
+        cutoff = self._cutoff()
+        for day in [day for day in self._days if day < cutoff]:
+            self.size -= len(self._days.pop(day))
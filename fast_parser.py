@@ -0,0 +1,353 @@
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Участки, которые всегда сводятся к "АОР" (см. правило 2 системного промпта)
+AOR_AREA = "АОР"
+AOR_MARKERS = {"пу", "отд", "кавказ", "север", "центр", "юг", "рассвет"}
+
+# Сокращения операций, которые не выводятся из префиксов названий
+OPERATION_ALIASES = {
+    "сзр": ["гербицидная", "обработка"],
+    "посев": ["сев"],
+}
+
+# Сокращения культур, которые не выводятся из префиксов названий
+CULTURE_ALIASES = {
+    "сил": "кормовая",
+    "силос": "кормовая",
+}
+
+# Признаки культуры по умолчанию, если тип не указан: сначала товарная,
+# для многолетних трав - текущего года
+CULTURE_DEFAULT_MARKERS = ("товарн", "текущего года")
+
+# Слова, которые не несут данных и не мешают разбору строки
+FILLER_WORDS = {"по", "и", "в", "за", "г", "год", "отчет", "итого", "га"}
+
+NUMBER = r"\d+(?:[.,]\d+)?"
+DATE_RE = re.compile(r"^\s*(\d{1,2})\.(\d{1,2})(?:\.(\d{2,4}))?(?![\d.])\s*[.,:;-]?")
+PERCENT_RE = re.compile(r"\(?\s*\d+(?:[.,]\d+)?\s*%.*$|%.*$")
+DAY_TOTAL_RE = re.compile(rf"день\s*[-:–—]?\s*({NUMBER})\s*(?:га)?.*?начала\s*[-:–—]?\s*({NUMBER})")
+PAIR_RE = re.compile(rf"({NUMBER})\s*(?:га)?\s*/\s*({NUMBER})")
+SINGLE_RE = re.compile(rf"({NUMBER})\s*га(?![а-я])")
+TOKEN_RE = re.compile(r"\d+(?:-[а-я]{1,2})?|[а-яa-z]+")
+ORDINAL_RE = re.compile(r"^(\d+)(?:-[а-я]{1,2})?$")
+
+
+def _normalize(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    # Всё, что после "Остаток" и после символа процента, не относится к отчету
+    text = text.split("остаток", 1)[0]
+    text = PERCENT_RE.sub("", text)
+    text = re.sub(r"кукуруз[а-я]*\s+на\s+зерно", "кукуруза", text)
+    text = text.replace("к.корм", "кукуруза корм")
+    return text
+
+
+def _token_matches(token: str, word: str) -> bool:
+    """Токен - префикс слова или то же слово в другом падеже"""
+    if len(token) < 2:
+        return False
+    if word.startswith(token):
+        return True
+    return len(token) == len(word) and len(token) >= 3 and token[:-1] == word[:-1]
+
+
+def _ordinal(token: str) -> Optional[int]:
+    match = ORDINAL_RE.match(token)
+    return int(match.group(1)) if match else None
+
+
+def _format_hectares(value: str) -> str:
+    """Четырехзначные значения га пишутся с запятой после первой цифры: 1816 -> 1,816"""
+    if value.isdigit() and len(value) == 4:
+        return f"{value[0]},{value[1:]}"
+    return value
+
+
+@dataclass
+class FastParseResult:
+    """Итог локального разбора сообщения.
+
+    lines - строки в формате ответа YandexGPT; None отмечает место,
+    куда нужно вставить ответ модели для нераспознанных строк.
+    llm_lines - нераспознанные строки в исходном порядке; перед каждой
+    стоят строки-заголовки с датой, участком и операцией, действующими для нее.
+    """
+    lines: list = field(default_factory=list)
+    unresolved: list = field(default_factory=list)
+    llm_lines: list = field(default_factory=list)
+
+    @property
+    def resolved_count(self) -> int:
+        return sum(1 for line in self.lines if line is not None)
+
+    def llm_input(self) -> str:
+        """Текст для YandexGPT: нераспознанные строки с заголовками, которые к ним относятся"""
+        return "\n".join(self.llm_lines)
+
+    def merge(self, llm_text: str = "") -> str:
+        """Собирает итоговый текст, подставляя ответ модели на место нераспознанных строк"""
+        result = []
+        for line in self.lines:
+            if line is not None:
+                result.append(line)
+            elif llm_text:
+                result.append(llm_text.strip())
+        return "\n".join(result)
+
+
+@dataclass
+class FastPathStats:
+    """Счетчики доли строк, разобранных без обращения к YandexGPT"""
+    messages: int = 0
+    local_messages: int = 0
+    local_lines: int = 0
+    llm_lines: int = 0
+
+    def record(self, result: FastParseResult):
+        self.messages += 1
+        self.local_lines += result.resolved_count
+        self.llm_lines += len(result.unresolved)
+        if not result.unresolved:
+            self.local_messages += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.local_lines + self.llm_lines
+        return self.local_lines / total if total else 0.0
+
+
+class FastParser:
+    """Детерминированный разбор типовых полевых отчетов без LLM.
+
+    Словарь сокращений строится из списков участков, операций и культур:
+    слово отчета сопоставляется со словом из списка, если является его
+    префиксом ("предп" -> "предпосевная") или отличается только окончанием
+    ("сою" -> "соя"). Строка считается распознанной, только если участок,
+    операция, культура и пара га определяются однозначно.
+    """
+
+    def __init__(self, areas: list, operations: list, cultures: list):
+        self.areas = []
+        for area in areas:
+            tokens = TOKEN_RE.findall(_normalize(area))
+            if tokens:
+                self.areas.append((area, tokens))
+
+        self.operations = []
+        for operation in operations:
+            tokens = TOKEN_RE.findall(_normalize(operation))
+            ordinal = next((_ordinal(t) for t in tokens if _ordinal(t) is not None), None)
+            words = [t for t in tokens if _ordinal(t) is None]
+            if words:
+                self.operations.append((operation, ordinal, words))
+
+        self.cultures = []
+        for culture in cultures:
+            words = TOKEN_RE.findall(_normalize(culture))
+            if words:
+                self.cultures.append((culture, words))
+
+    def parse(self, text: str) -> FastParseResult:
+        result = FastParseResult()
+        date = None
+        area = None
+        operation = None
+        llm_slot_added = False
+        # Дата, участок и операция, уже переданные модели; заголовки, которые их задают
+        sent_context = (None, None, None)
+        headers = []
+
+        for raw_line in text.split("\n"):
+            if not raw_line.strip():
+                continue
+            line = _normalize(raw_line)
+
+            date_match = DATE_RE.match(line)
+            if date_match:
+                day, month, year = date_match.groups()
+                if 1 <= int(day) <= 31 and 1 <= int(month) <= 12:
+                    date = f"{int(day):02d}.{int(month):02d}" + (f".{year}" if year else "")
+                    line = line[date_match.end():]
+
+            tokens = TOKEN_RE.findall(line)
+            line_area, tokens = self._extract_area(tokens)
+            hectares = self._extract_hectares(line)
+            line_operation, tokens = self._match_operation(tokens)
+            culture = self._match_culture(tokens, line_operation is not None)
+
+            if line_area is False:
+                parsed = None  # в строке несколько разных участков
+            elif hectares is not None and self._culture_after(line[hectares[2]:]):
+                parsed = None  # после первой пары га идет другая культура: строку разбирает модель
+            elif hectares is None:
+                if culture is None and self._is_header(tokens):
+                    # Строка-заголовок: задает дату, участок или операцию для следующих строк
+                    area = line_area or area
+                    operation = line_operation or operation
+                    headers.append(raw_line.strip())
+                    continue
+                parsed = None
+            else:
+                current_area = line_area or area
+                current_operation = line_operation or operation
+                if current_area and current_operation and culture:
+                    day_ha, total_ha, _ = hectares
+                    parsed = "; ".join([
+                        date or "00.00.00",
+                        current_area,
+                        current_operation,
+                        culture,
+                        _format_hectares(day_ha),
+                        _format_hectares(total_ha),
+                    ])
+                else:
+                    parsed = None
+
+            if parsed is not None:
+                result.lines.append(parsed)
+                if line_area:
+                    area = line_area
+            else:
+                context = (date, area, operation)
+                if headers:
+                    # Исходные заголовки передаются в своем порядке перед строками, к которым относятся
+                    result.llm_lines.extend(headers)
+                    headers = []
+                elif context != sent_context and any(context):
+                    # Дату или участок задала строка, разобранная локально: повторяем их заголовком
+                    result.llm_lines.append(" ".join(value for value in context if value))
+                sent_context = context
+                result.llm_lines.append(raw_line.strip())
+                result.unresolved.append(raw_line.strip())
+                if not llm_slot_added:
+                    result.lines.append(None)
+                    llm_slot_added = True
+
+        return result
+
+    def _extract_area(self, tokens: list):
+        """Находит участок в строке и убирает его слова; False - если участков несколько"""
+        found = set()
+        remaining = list(tokens)
+
+        if any(token in AOR_MARKERS for token in remaining):
+            found.add(AOR_AREA)
+            remaining = [token for token in remaining if token not in AOR_MARKERS]
+
+        for area, words in self.areas:
+            for start in range(len(remaining) - len(words) + 1):
+                if remaining[start:start + len(words)] == words:
+                    found.add(AOR_AREA if area == AOR_AREA else area)
+                    del remaining[start:start + len(words)]
+                    break
+
+        remaining = [token for token in remaining if token != "по"]
+        if len(found) > 1:
+            return False, remaining
+        return (found.pop() if found else None), remaining
+
+    @staticmethod
+    def _extract_hectares(line: str):
+        """Возвращает (за день, с начала операции, позиция конца первой пары в строке) или None"""
+        match = DAY_TOTAL_RE.search(line) or PAIR_RE.search(line)
+        if match:
+            return match.group(1), match.group(2), match.end()
+
+        singles = list(SINGLE_RE.finditer(line))
+        if len({single.group(1) for single in singles}) == 1:
+            return singles[0].group(1), singles[0].group(1), singles[0].end()
+        return None
+
+    def _culture_after(self, text: str) -> bool:
+        """Есть ли в тексте слово, с которого начинается название культуры ("сою", "кук")"""
+        for token in TOKEN_RE.findall(text):
+            if len(token) < 3 or token in FILLER_WORDS or token in AOR_MARKERS:
+                continue
+            token = CULTURE_ALIASES.get(token, token)
+            if any(_token_matches(token, culture_words[0]) for _, culture_words in self.cultures):
+                return True
+        return False
+
+    def _match_operation(self, tokens: list):
+        """Сопоставляет начало строки с операцией; возвращает операцию и оставшиеся токены"""
+        ordinal = None
+        words = []
+        rest_start = len(tokens)
+        for index, token in enumerate(tokens):
+            if token == "под":
+                rest_start = index
+                break
+            token_ordinal = _ordinal(token)
+            if token_ordinal is not None:
+                if "-" in token or (index == 0 and ordinal is None):
+                    ordinal = token_ordinal
+                    continue
+                rest_start = index
+                break
+            words.extend(OPERATION_ALIASES.get(token, [token]))
+
+        if not words or len(words[0]) < 3:
+            return None, tokens
+
+        best = []
+        for operation, op_ordinal, op_words in self.operations:
+            if op_ordinal != ordinal or len(op_words) > len(words):
+                continue
+            if all(_token_matches(words[i], op_words[i]) for i in range(len(op_words))):
+                best.append((len(op_words), operation))
+
+        if not best:
+            return None, tokens
+        best.sort(reverse=True)
+        if len(best) > 1 and best[0][0] == best[1][0]:
+            return None, tokens  # неоднозначное сокращение
+
+        # Оставшиеся слова до "под" считаем культурой только если "под" нет
+        matched = best[0][0]
+        leftover = words[matched:]
+        return best[0][1], leftover + tokens[rest_start:]
+
+    def _match_culture(self, tokens: list, after_operation: bool) -> Optional[str]:
+        if tokens.count("под") > 1:
+            return None  # несколько культур в одной строке разбираем через LLM
+        if "под" in tokens:
+            tokens = tokens[tokens.index("под") + 1:]
+        elif not after_operation:
+            return None
+
+        words = []
+        for token in tokens:
+            if _ordinal(token) is not None or token in ("га", "день", "от"):
+                break
+            if token not in FILLER_WORDS:
+                words.append(CULTURE_ALIASES.get(token, token))
+        if not words:
+            return None
+
+        candidates = []
+        for culture, culture_words in self.cultures:
+            if not any(_token_matches(word, culture_words[0]) for word in words):
+                continue
+            if all(any(_token_matches(word, cw) for cw in culture_words) for word in words):
+                candidates.append((culture, culture_words))
+
+        if len(candidates) == 1:
+            return candidates[0][0]
+
+        # Точное совпадение по всем словам, например "сорго" -> "Сорго"
+        exact = [culture for culture, culture_words in candidates if len(culture_words) == len(words)]
+        if len(exact) == 1:
+            return exact[0]
+
+        for marker in CULTURE_DEFAULT_MARKERS:
+            defaults = [culture for culture, _ in candidates if marker in culture.lower()]
+            if len(defaults) == 1:
+                return defaults[0]
+        return None
+
+    @staticmethod
+    def _is_header(tokens: list) -> bool:
+        return all(token in FILLER_WORDS for token in tokens)
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+import gspread
+from googleapiclient.discovery import build
+from oauth2client.service_account import ServiceAccountCredentials
+
+logger = logging.getLogger(__name__)
+
+SCOPE = [
+    'https://spreadsheets.google.com/feeds',
+    'https://www.googleapis.com/auth/drive.file',
+    'https://www.googleapis.com/auth/drive'
+]
+
+SHEET_HEADER = [
+    "Дата",
+    "Подразделение",
+    "Операция",
+    "Культура",
+    "За день, га",
+    "С начала операции, га"
+]
+
+
+class GoogleServices:
+    """Подключения к Google Sheets и Drive, открываемые при первом обращении.
+
+    Методы синхронные и вызываются из рабочих потоков (буфер записи,
+    архивация), поэтому каждое подключение создается под блокировкой ровно один раз.
+    """
+
+    def __init__(self, credentials_file: str, spreadsheet_key: str):
+        self.credentials_file = credentials_file
+        self.spreadsheet_key = spreadsheet_key
+        self._credentials = None
+        self._worksheet = None
+        self._drive = None
+        self._lock = threading.Lock()
+
+    @property
+    def credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                    self.credentials_file, SCOPE
+                )
+            return self._credentials
+
+    def worksheet(self):
+        """Первый лист таблицы отчетов; при первом открытии проверяет заголовки"""
+        if self._worksheet is not None:
+            return self._worksheet
+        credentials = self.credentials
+        with self._lock:
+            if self._worksheet is None:
+                client = gspread.authorize(credentials)
+                worksheet = client.open_by_key(self.spreadsheet_key).sheet1
+                if not worksheet.row_values(1):
+                    worksheet.append_row(SHEET_HEADER)
+                self._worksheet = worksheet
+                logger.info("Подключение к Google Sheets открыто")
+            return self._worksheet
+
+    def drive(self):
+        """Клиент Google Drive API.
+
+        Документ discovery берется из копии, поставляемой с google-api-python-client,
+        поэтому создание клиента не обращается к сети.
+        """
+        if self._drive is not None:
+            return self._drive
+        credentials = self.credentials
+        with self._lock:
+            if self._drive is None:
+                self._drive = build('drive', 'v3', credentials=credentials,
+                                    static_discovery=True, cache_discovery=False)
+                logger.info("Клиент Google Drive создан")
+            return self._drive
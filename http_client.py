@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+import random
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class ApiResult:
+    """Результат обращения к API: либо данные, либо описание ошибки"""
+    status: int
+    data: Optional[dict] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class LLMResult:
+    """Ответ YandexGPT: расшифрованный текст или описание ошибки"""
+    text: str = ""
+    error: Optional[str] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class CompletionStream:
+    """Потоковый ответ YandexGPT: каждая часть содержит весь текст с начала генерации.
+
+    Законченные строки (за которыми уже пришел перевод строки) передаются
+    в on_line по одной и только один раз; последняя строка - в finish().
+    """
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.text = ""
+        self._emitted = 0
+
+    async def feed(self, data: dict):
+        try:
+            self.text = data['result']['alternatives'][0]['message']['text']
+        except (KeyError, IndexError, TypeError):
+            return
+        await self._emit(self.text.split('\n')[:-1])
+
+    async def finish(self):
+        await self._emit(self.text.split('\n'))
+
+    async def _emit(self, lines: list):
+        for line in lines[self._emitted:]:
+            self._emitted += 1
+            if line.strip():
+                await self.on_line(line.strip())
+
+
+@dataclass
+class TokenUsage:
+    """Накопленный расход токенов YandexGPT"""
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+    def add(self, input_tokens: int, output_tokens: int):
+        self.requests += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+
+
+class ApiClient:
+    """Общий HTTP-клиент с пулом keep-alive соединений и повторами запросов.
+
+    Создаётся один раз при старте бота и используется для всех обращений
+    к YandexGPT и IAM, чтобы не открывать новое TCP+TLS соединение на каждый запрос.
+    """
+
+    def __init__(self,
+                 limit_per_host: int = 10,
+                 connect_timeout: float = 5,
+                 read_timeout: float = 30,
+                 max_retries: int = 3,
+                 max_throttle_retries: int = 10,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 10):
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.max_throttle_retries = max_throttle_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._session = None
+
+    async def start(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Экспоненциальная задержка с полным джиттером; учитывает Retry-After"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def post_json(self, url: str, payload: dict, headers: Optional[dict] = None,
+                        limiter=None, tokens: float = 0, on_data=None) -> ApiResult:
+        """POST с JSON-телом; повторяет запрос при 5xx/429 и сетевых ошибках.
+
+        Если передан limiter (AdaptiveRateLimiter), каждая попытка ждет в его очереди;
+        tokens - оценка расхода токенов модели для лимита в минуту.
+        Если передан on_data, ответ читается потоком: каждая строка - отдельный
+        JSON-объект, который передается в on_data, а в результате остается последний.
+        После первого полученного объекта запрос не повторяется.
+        """
+        if self._session is None:
+            return ApiResult(status=0, error="HTTP-клиент не запущен")
+
+        attempt = 0
+        throttled_attempts = 0
+        received = False
+        while True:
+            retry_after = None
+            async with (limiter.slot(tokens) if limiter is not None else nullcontext({})) as state:
+                try:
+                    async with self._session.post(url, json=payload, headers=headers) as response:
+                        if response.status == 200:
+                            if on_data is None:
+                                return ApiResult(status=200, data=await response.json())
+                            data = None
+                            async for raw in response.content:
+                                if not raw.strip():
+                                    continue
+                                data = json.loads(raw)
+                                received = True
+                                await on_data(data)
+                            return ApiResult(status=200, data=data)
+                        result = ApiResult(status=response.status, error=await response.text())
+                        retry_after = response.headers.get("Retry-After")
+                        state["throttled"] = response.status == 429
+                        if response.status not in RETRY_STATUSES:
+                            return result
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    result = ApiResult(status=0, error=f"{type(e).__name__}: {str(e)}")
+
+            # Часть потокового ответа уже передана получателю, повтор ее продублирует
+            if received:
+                return result
+
+            # Превышение квоты повторяем дольше: запрос должен дождаться своей очереди, а не потеряться
+            if result.status == 429:
+                throttled_attempts += 1
+                retries_left = throttled_attempts <= self.max_throttle_retries
+            else:
+                attempt += 1
+                retries_left = attempt <= self.max_retries
+            if not retries_left:
+                return result
+
+            delay = self._backoff(attempt + throttled_attempts - 1, retry_after)
+            logger.warning(f"Повтор запроса к {url} через {delay:.1f} с "
+                           f"(попытка {attempt + throttled_attempts + 1}, статус {result.status})")
+            await asyncio.sleep(delay)
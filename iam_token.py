@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import re
+import time
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+EXPIRES_AT_RE = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:\d{2})?$")
+
+
+def parse_expires_at(value: str) -> Optional[float]:
+    """Время истечения токена из поля expiresAt (RFC 3339, до наносекунд) в секундах Unix"""
+    match = EXPIRES_AT_RE.match(value.strip()) if value else None
+    if not match:
+        return None
+    base, fraction, zone = match.groups()
+    # datetime понимает не больше шести знаков долей секунды
+    fraction = f".{fraction[:6]}" if fraction else ""
+    zone = "+00:00" if zone in (None, "Z") else zone
+    return datetime.fromisoformat(base + fraction + zone).timestamp()
+
+
+class IamTokenManager:
+    """Хранит IAM-токен в памяти и обновляет его заранее, до истечения срока.
+
+    fetch() возвращает пару (токен, время истечения в секундах Unix или None)
+    либо None при ошибке. Фоновая задача обновляет токен за refresh_margin
+    секунд до истечения; одновременные вызовы refresh() ждут один запрос.
+    """
+
+    def __init__(self, fetch, refresh_margin: float = 3600, default_ttl: float = 3600,
+                 retry_interval: float = 30):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.retry_interval = retry_interval
+        self.token = None
+        self.expires_at = 0.0
+        self.failed = False
+        self._refreshing = None
+        self._task = None
+
+    async def start(self) -> bool:
+        """Получает первый токен и запускает фоновое обновление"""
+        await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+        return self.token is not None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def refresh(self, stale: Optional[str] = None) -> Optional[str]:
+        """Получает новый токен; stale - отвергнутый API токен.
+
+        Если токен уже сменился после stale, новый запрос не делается.
+        """
+        if stale is not None and self.token != stale:
+            return self.token
+        # Отмена одного из ожидающих не прерывает общий запрос
+        await asyncio.shield(self._shared_fetch())
+        return self.token
+
+    def _shared_fetch(self) -> asyncio.Future:
+        """Текущий запрос токена; новый запускается, только если другого нет"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._fetch())
+            self._refreshing.add_done_callback(self._refresh_done)
+        return self._refreshing
+
+    def _refresh_done(self, future):
+        self._refreshing = None
+
+    async def _fetch(self) -> bool:
+        try:
+            result = await self.fetch()
+        except Exception as e:
+            logger.error(f"Ошибка получения IAM-токена: {str(e)}")
+            result = None
+        if result is None:
+            self.failed = True
+            return False
+        self.failed = False
+        self.token, expires_at = result
+        self.expires_at = expires_at or time.time() + self.default_ttl
+        logger.info(f"IAM-токен обновлен, действует до {datetime.fromtimestamp(self.expires_at):%d.%m.%Y %H:%M:%S}")
+        return True
+
+    def _next_refresh_delay(self) -> float:
+        # Пока обновление не удалось, повторяем через retry_interval, а не по сроку старого токена
+        if self.token is None or self.failed:
+            return self.retry_interval
+        lifetime = self.expires_at - time.time()
+        # Короткоживущий токен обновляется на середине срока, а не сразу
+        margin = min(self.refresh_margin, lifetime / 2)
+        return max(1.0, lifetime - margin)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self._next_refresh_delay())
+            if not await asyncio.shield(self._shared_fetch()):
+                # Старый токен еще действует до expires_at, повторяем чаще
+                logger.warning(f"Не удалось обновить IAM-токен, повтор через {self.retry_interval} с")
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+
+from http_client import LLMResult
+
+logger = logging.getLogger(__name__)
+
+BATCH_HEADER = (
+    "Ниже несколько независимых сообщений. Обработай каждое отдельно по тем же правилам. "
+    "Перед ответом на каждое сообщение выведи строку-разделитель ровно в виде \"### N\", "
+    "где N - номер сообщения, и сохраняй порядок сообщений."
+)
+SEPARATOR_RE = re.compile(r"^\s*###\s*(\d+)\s*$", re.MULTILINE)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов YandexGPT для русского текста"""
+    return len(text) // 3 + 1
+
+
+def build_batch_input(texts: list) -> str:
+    parts = [BATCH_HEADER]
+    for number, text in enumerate(texts, 1):
+        parts.append(f"### {number}\n{text.strip()}")
+    return "\n".join(parts)
+
+
+def is_valid_block(text: str) -> bool:
+    """Ответ на одно сообщение: непустой и каждая строка содержит не меньше 5 полей"""
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    return bool(lines) and all(len(line.split(';')) >= 5 for line in lines)
+
+
+def split_batch_output(text: str, count: int) -> list:
+    """Разделяет ответ модели по строкам "### N"; None - для сообщений без корректного ответа"""
+    blocks = [None] * count
+    matches = list(SEPARATOR_RE.finditer(text))
+    for index, match in enumerate(matches):
+        number = int(match.group(1))
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        block = text[match.end():end].strip()
+        if 1 <= number <= count and blocks[number - 1] is None and is_valid_block(block):
+            blocks[number - 1] = block
+    return blocks
+
+
+@dataclass
+class _BatchItem:
+    text: str
+    future: asyncio.Future = field(repr=False)
+
+
+@dataclass
+class BatchStats:
+    batches: int = 0
+    batched_messages: int = 0
+    fallbacks: int = 0
+
+
+class LLMBatcher:
+    """Объединяет сообщения, пришедшие в течение window секунд, в один запрос к YandexGPT.
+
+    В пачку попадает не больше max_messages сообщений и не больше token_budget
+    оценочных входных токенов, так что системный промпт передается один раз
+    на пачку. Ответ делится обратно по разделителям; сообщения, для которых
+    ответ не удалось разобрать, обрабатываются отдельными запросами.
+    complete(text, max_tokens) - функция одного запроса к модели.
+    """
+
+    def __init__(self, complete, window: float = 0.3, max_messages: int = 10,
+                 token_budget: int = 3000, max_output_tokens: int = 8000):
+        self.complete = complete
+        self.window = window
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.max_output_tokens = max_output_tokens
+        self.stats = BatchStats()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = None
+        self._calls = set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        if self._calls:
+            await asyncio.gather(*self._calls, return_exceptions=True)
+
+    async def expand(self, text: str) -> LLMResult:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_BatchItem(text=text, future=future))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            tokens = estimate_tokens(item.text)
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_messages:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                tokens += estimate_tokens(item.text)
+                if tokens >= self.token_budget:
+                    break
+
+            # Запрос выполняется в фоне, чтобы следующая пачка собиралась параллельно
+            call = asyncio.create_task(self._process(batch))
+            self._calls.add(call)
+            call.add_done_callback(self._calls.discard)
+
+    async def _process(self, batch: list):
+        try:
+            if len(batch) == 1:
+                self._resolve(batch[0], await self.complete(batch[0].text))
+                return
+
+            texts = [item.text for item in batch]
+            max_tokens = min(self.max_output_tokens, 2000 * len(batch))
+            result = await self.complete(build_batch_input(texts), max_tokens)
+            blocks = split_batch_output(result.text, len(batch)) if result.ok else [None] * len(batch)
+
+            self.stats.batches += 1
+            self.stats.batched_messages += len(batch)
+            failed = [item for item, block in zip(batch, blocks) if block is None]
+            for item, block in zip(batch, blocks):
+                if block is not None:
+                    self._resolve(item, LLMResult(text=block))
+
+            if failed:
+                self.stats.fallbacks += len(failed)
+                logger.warning(f"Пакет из {len(batch)} сообщений: {len(failed)} обрабатываются отдельными запросами")
+                results = await asyncio.gather(*(self.complete(item.text) for item in failed))
+                for item, single in zip(failed, results):
+                    self._resolve(item, single)
+        except Exception as e:
+            logger.error(f"Ошибка пакетной обработки: {str(e)}")
+            for item in batch:
+                self._resolve(item, LLMResult(error=f"Ошибка пакетной обработки: {str(e)}"))
+
+    @staticmethod
+    def _resolve(item: _BatchItem, result: LLMResult):
+        if not item.future.done():
+            item.future.set_result(result)
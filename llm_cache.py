@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import aiosqlite
+
+from http_client import LLMResult
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к виду, не зависящему от лишних пробелов и пустых строк"""
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def fingerprint(*parts: str) -> str:
+    """Отпечаток словарей и промпта: при их изменении старые ответы не используются"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.memory_hits + self.disk_hits + self.coalesced
+        total = hits + self.misses
+        return hits / total if total else 0.0
+
+
+class LLMCache:
+    """Кэш ответов YandexGPT с адресацией по содержимому.
+
+    Ключ - хэш нормализованного текста и отпечатка словарей/промпта.
+    Первый уровень - LRU в памяти, второй - таблица SQLite; записи старше
+    ttl секунд не используются. Одновременные запросы с одинаковым ключом
+    объединяются в один вызов модели.
+    """
+
+    def __init__(self, db_path: str, vocabulary_fingerprint: str,
+                 max_entries: int = 1000, ttl: float = 7 * 24 * 3600):
+        self.db_path = db_path
+        self.vocabulary_fingerprint = vocabulary_fingerprint
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._memory = OrderedDict()
+        self._in_flight = {}
+        self._db = None
+
+    async def open(self):
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        await self._db.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,))
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def key(self, text: str) -> str:
+        return fingerprint(self.vocabulary_fingerprint, normalize_text(text))
+
+    async def get_or_compute(self, text: str, compute) -> LLMResult:
+        """Возвращает ответ из кэша или вызывает compute() и сохраняет успешный ответ"""
+        key = self.key(text)
+
+        cached = await self._get(key)
+        if cached is not None:
+            return LLMResult(text=cached)
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.stats.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        self.stats.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await compute()
+            if result.ok:
+                await self._set(key, result.text)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, само будущее больше не нужно
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _get(self, key: str):
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            text, created = entry
+            if now - created < self.ttl:
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return text
+            del self._memory[key]
+
+        if self._db is None:
+            return None
+        try:
+            async with self._db.execute(
+                "SELECT text, created FROM llm_cache WHERE key = ?", (key,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша: {str(e)}")
+            return None
+
+        if row is None or now - row[1] >= self.ttl:
+            return None
+        self._remember(key, row[0], row[1])
+        self.stats.disk_hits += 1
+        return row[0]
+
+    async def _set(self, key: str, text: str):
+        created = time.time()
+        self._remember(key, text, created)
+        if self._db is None:
+            return
+        try:
+            await self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, text, created) VALUES (?, ?, ?)",
+                (key, text, created)
+            )
+            await self._db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш: {str(e)}")
+
+    def _remember(self, key: str, text: str, created: float):
+        self._memory[key] = (text, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
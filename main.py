@@ -1,20 +1,112 @@
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.filters import Command
 from aiogram.types import Message
 import asyncio
-import aiohttp
+import base64
+import io
+import ipaddress
 import logging
-from datetime import datetime
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-from io import BytesIO
+import multiprocessing
+import re
+import secrets
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime
 
-# Добавляем новые импорты и настройки
-import os
-from collections import defaultdict
+from counter_store import CounterStore
+from duplicate_index import DuplicateIndex, row_fingerprint
+from drive_archiver import DriveArchiver
+from fast_parser import FastParser, FastPathStats
+from google_services import GoogleServices
+from http_client import ApiClient, CompletionStream, LLMResult, TokenUsage
+from iam_token import IamTokenManager, parse_expires_at
+from llm_batcher import LLMBatcher, estimate_tokens
+from llm_cache import LLMCache, fingerprint
+from metrics import (
+    FIRST_ROW_SECONDS, IAM_REFRESH, LLM_REQUEST_SECONDS, LLM_TOKENS, OCR_REQUEST_SECONDS, PARSE_SECONDS, REGISTRY,
+    REPORT_LINES, TraceIdFilter, new_trace_id, start_metrics_server
+)
+from model_router import ModelRouter
+from outbox import Outbox
+from photo_ocr import OcrResult, PhotoProcessor
+from pipeline import Pipeline, Stage
+from prompt import PromptStore
+from rate_limiter import AdaptiveRateLimiter
+from report_store import ReportStore
+from sheet_sink import SheetSink
+from webhook import WorkerPool, start_webhook_server
 
 COUNTERS_FILE = 'counters.txt'
+DATABASE_FILE = 'agro_bot.db'
+VOCABULARY_FILES = ('areas.txt', 'operations.txt', 'cultures.txt')
+
+# Объединение сообщений, пришедших почти одновременно, в один запрос к YandexGPT
+LLM_BATCHING = False
+LLM_BATCH_WINDOW = 0.3  # секунды ожидания попутных сообщений
+LLM_BATCH_MAX_MESSAGES = 10
+LLM_BATCH_TOKEN_BUDGET = 3000  # оценочные входные токены сообщений в пачке
+
+# Потоковый ответ YandexGPT: строки разбираются и фиксируются по мере генерации
+# (запросы в этом режиме не объединяются в пачки)
+LLM_STREAMING = False
+
+# Короткие сообщения (до LITE_MAX_LINES строк) сначала отправляются в YandexGPT Lite
+# с maxTokens по числу строк; если ее ответ не проходит проверку строк, сообщение
+# повторяется в полной модели. В потоковом режиме всегда используется полная модель
+LLM_ROUTING = True
+LITE_MAX_LINES = 4
+LITE_TOKENS_PER_LINE = 60
+
+# Строки, уже записанные в таблицу, повторно не пишутся. Индекс хранит хеши строк
+# за последние DUPLICATE_INDEX_DAYS дней; None - за все время
+DUPLICATE_INDEX_DAYS = None
+# Сколько секунд запись строк ждет первой загрузки индекса при запуске; дальше проверка идет по неполному индексу
+DUPLICATE_INDEX_WAIT = 120
+
+# Квоты внешних API: запросы в секунду, токены модели в минуту и максимум одновременных запросов
+RATE_LIMITS = {
+    "yandexgpt": {"requests_per_second": 10, "tokens_per_minute": 200000, "max_concurrency": 10},
+    "iam": {"requests_per_second": 1, "max_concurrency": 1},
+    "sheets": {"requests_per_second": 1, "max_concurrency": 1},
+    "drive": {"requests_per_second": 5, "max_concurrency": 4},
+    "vision": {"requests_per_second": 5, "max_concurrency": 4},
+}
+
+# Фото отчетов: изображение уменьшается и переводится в черно-белое в PHOTO_WORKERS
+# процессах, одновременно обрабатывается до PHOTO_CONCURRENCY фото, а загруженные
+# изображения занимают в памяти не больше PHOTO_MEMORY_LIMIT байт
+PHOTO_WORKERS = 2
+PHOTO_CONCURRENCY = 4
+PHOTO_MEMORY_LIMIT = 64 * 1024 * 1024
+PHOTO_MAX_SIDE = 2000  # пикселей по большей стороне
+
+# Параллельность и размер очереди каждого этапа конвейера обработки
+PIPELINE_STAGES = {
+    "expand": {"concurrency": 8, "queue_size": 100},
+    "parse": {"concurrency": 1, "queue_size": 100},
+    "write": {"concurrency": 16, "queue_size": 200},
+    "archive": {"concurrency": 2, "queue_size": 200},
+}
+
+# Строк в одном вызове append_rows при доставке очереди записи в таблицу
+OUTBOX_BATCH_ROWS = 200
+
+# Эндпоинт метрик Prometheus; None - не запускать
+# (в режиме вебхука процесс-обработчик i использует порт METRICS_PORT + 1 + i)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Прием обновлений через вебхук вместо long polling: основной процесс принимает
+# обновления и пишет строки в таблицу, сообщения обрабатываются в WEBHOOK_WORKERS
+# процессах, каждый чат закреплен за одним процессом
+WEBHOOK_MODE = False
+WEBHOOK_URL = None  # публичный адрес для setWebhook; None - вебхук зарегистрирован вручную
+WEBHOOK_HOST = '127.0.0.1'  # за обратным прокси; другой адрес - только с WEBHOOK_URL или WEBHOOK_SECRET
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET = None  # None - случайный секрет при каждой регистрации вебхука, без WEBHOOK_URL - без проверки
+WEBHOOK_WORKERS = 4
+WEBHOOK_QUEUE_SIZE = 1000  # обновлений в очереди одного процесса
 
 from config import (
     TELEGRAM_TOKEN, 
@@ -25,79 +117,39 @@ from config import (
     GOOGLE_DRIVE_FOLDER_ID
 )
 
-# Глобальная переменная для хранения текущего IAM-токена
-current_iam_token = None
-message_counters = defaultdict(int)
-
-# Настройка Google Sheets
-scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive.file', 'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDS, scope)
-client = gspread.authorize(creds)
-sheet = client.open_by_key(SPREADSHEET_KEY).sheet1
-drive_service = build('drive', 'v3', credentials=creds)
-
-# Функция для сохранения счетчиков в файл
-def save_counters():
-    with open(COUNTERS_FILE, 'w', encoding='utf-8') as f:
-        for user_id, count in message_counters.items():
-            f.write(f"{user_id},{count}\n")
-
-# Изменяем функцию загрузки счетчиков
-def load_counters():
-    if os.path.exists(COUNTERS_FILE):
-        with open(COUNTERS_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    user_id, count = line.strip().split(',')
-                    message_counters[int(user_id)] = int(count)
-                except ValueError:
-                    logger.warning(f"Некорректная строка в файле счетчика: {line}")
-                
-# Вызываем загрузку при старте
-load_counters()
-
-# Функция для создания файла в Google Drive
-async def save_to_drive(content: str, filename: str, folder_id: str):
-    try:
-        file_metadata = {
-            'name': filename,
-            'parents': [folder_id],
-            'mimeType': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        }
-        
-        # Создаем временный файл в памяти
-        file_content = BytesIO(content.encode('utf-8'))
-        media = MediaIoBaseUpload(file_content, 
-                                mimetype='text/plain',
-                                resumable=True)
-        
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-        
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка сохранения в Google Drive: {str(e)}")
-        return False
-
-# Проверка и создание заголовков таблицы
-header = sheet.row_values(1)
-if not header:
-    sheet.append_row([
-        "Дата",
-        "Подразделение", 
-        "Операция", 
-        "Культура", 
-        "За день, га", 
-        "С начала операции, га"
-    ])
-
 # Настройка логгирования
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:[%(trace_id)s] %(message)s")
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
 logger = logging.getLogger(__name__)
 
+api_client = None
+llm_cache = None
+llm_batcher = None
+model_router = None
+sheet_sink = None
+counter_store = None
+drive_archiver = None
+outbox = None
+pipeline = None
+photo_processor = None
+photo_tasks = set()
+report_store_task = None
+metrics_runner = None
+startup_timings = {}
+
+# Ограничители запросов к каждому внешнему API
+limiters = {name: AdaptiveRateLimiter(name, **settings) for name, settings in RATE_LIMITS.items()}
+
+# Google Sheets и Drive открываются при первом обращении, а не при импорте
+google = GoogleServices(GOOGLE_SHEETS_CREDS, SPREADSHEET_KEY)
+
+IAM_URL = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
+COMPLETION_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+MODEL_URI = f"gpt://{YC_FOLDER_ID}/yandexgpt"
+LITE_MODEL_URI = f"gpt://{YC_FOLDER_ID}/yandexgpt-lite"
+OCR_URL = "https://ocr.api.cloud.yandex.net/ocr/v1/recognizeText"
+
 async def get_new_iam_token():
     headers = {
         "Content-Type": "application/json"
@@ -107,39 +159,17 @@ async def get_new_iam_token():
         "yandexPassportOauthToken": YC_API_KEY
     }
     
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://iam.api.cloud.yandex.net/iam/v1/tokens",
-                headers=headers,
-                json=data,
-                timeout=10
-            ) as response:
-                if response.status != 200:
-                    error = await response.text()
-                    logger.error(f"IAM token error: {response.status} - {error}")
-                    return None
-                
-                result = await response.json()
-                return result.get('iamToken')
-                
-    except Exception as e:
-        logger.error(f"Ошибка получения IAM-токена: {str(e)}")
+    result = await api_client.post_json(IAM_URL, data, headers=headers, limiter=limiters["iam"])
+    if not result.ok:
+        IAM_REFRESH.inc(result="error")
+        logger.error(f"IAM token error: {result.status} - {result.error}")
         return None
-
-async def refresh_iam_token(interval: int = 3600):
-    """Обновляет IAM-токен каждые interval секунд"""
-    global current_iam_token
     
-    while True:
-        new_token = await get_new_iam_token()
-        if new_token:
-            current_iam_token = new_token
-            logger.info("IAM-токен успешно обновлен")
-        else:
-            logger.error("Не удалось обновить IAM-токен")
-        
-        await asyncio.sleep(interval)
+    IAM_REFRESH.inc(result="ok")
+    return result.data.get('iamToken'), parse_expires_at(result.data.get('expiresAt'))
+
+# Текущий IAM-токен хранится в памяти и обновляется в фоне до истечения срока
+iam_tokens = IamTokenManager(get_new_iam_token)
 
 # Загрузка названий участков из areas.txt
 def load_areas(filename="areas.txt"):
@@ -147,16 +177,12 @@ def load_areas(filename="areas.txt"):
     with open(filename, encoding='utf-8') as file:
         return [line.strip() for line in file]
 
-AREAS = load_areas()
-
 # Загрузка названий операций из operations.txt
 def load_operations(filename="operations.txt"):
     """Загружаем возможные операции из файла"""
     with open(filename, encoding='utf-8') as file:
         return [line.strip() for line in file]
 
-OPERATIONS = load_operations()
-
 # Загрузка названий культур из cultures.txt
 def load_culture_rules():
     try:
@@ -203,124 +229,92 @@ def load_culture_rules():
         logger.error(f"Ошибка при чтении cultures.txt: {str(e)}")
         return ""
 
-CULTURE_RULES = load_culture_rules()
-
-async def expand_abbreviations(text: str) -> str:
-    if not current_iam_token:
-        return "Ошибка: IAM-токен не инициализирован"
-    
-    system_prompt = f"""
-    Ты — высококласнный опытный агроном, который расшифровывает сокращённые названия производственного участка, сельскохозяйственных операций, культур, га вспаханные за день и га с начала операции. 
-
-    Строго соблюдай эти правила:
-    
-    0. Всегда используй СТРОГО ТОЛЬКО эти списки для итогового вывода ПРОИЗВОДСТВЕННЫЙ УЧАСТОК, ОПЕРАЦИЯ и КУЛЬТУРА:
-    {AREAS}
-    {OPERATIONS}
-    {CULTURE_RULES}
-
-    1. Подготовка данных:
-    - Если дата указана В НАЧАЛЕ один раз внутри всего сообщения, то это означает, что используется та же ДАТА для всех операции и надо его вписывать
-    - Если там указана дата, то СТРОГО впиши в формате день.месяц.год, где . является разделителем внутри даты
-    - Оставь дату 00.00.00, если нет никакой даты внутри сообщения (не путать с га)
-    - Полностью строго ИГНОРИРУЙ числа, которые связаны с ОСТАТОК, например "Остаток 5763 га"
-    - Полностью строго ИГНОРИРУЙ тексты идущие после символа процента, например "131га (3%) Остаток 448 га Осадки 1мм" строго рассматривай как "131га (3%)"
-
-    2. Обработка АОР (особое правило):
-    - Все номера ПУ/Отд → всегда заменяй на "АОР"
-    - Все названия Производственных участков из этого списка → всегда заменяй на "АОР": Кавказ, Север, Центр, Юг, Рассвет
-    - Примеры преобразований: "Отд 12" → "АОР" | "ПУ 7" → "АОР" | "Пу19" → "АОР" | "Кавказ" → "АОР" | "Рассвет" → "АОР" | "Юг" → "АОР"
-    
-    3. Стандартные преобразования:
-    - Дата может быть указана с годом или без года, если без года, то это означает, что используется текущий год
-    - Из первых строк расшифруй производственный участок, строго выбирая из списка производственных участков и сохрани название данного производственного участка строго для всех операций и культур при выходе!
-    - Для каждой строки определяй выполняемую операцию и тип культуры
-    - Операции, которые записаны в виде короткого обозначения, тебе нужно правильно определить операцию среди списка {OPERATIONS} возможных вариантов
-    - Если операция указана неполностью, постарайся восстановить полностью её из контекста, строго выбирая операцию из списка операций {OPERATIONS}
-    - Если в сокращении не указан тип культуры, выбирай именно тип ТОВАРНЫЙ/ТОВАРНАЯ обязательно
-    - Если культура определена "Кукуруза" и его тип не указан, СТРОГО выбирай "Кукуруза товарная"
-    - Если культура определена "Кукуруза" и есть слово "на зерно", СТРОГО значит выбирай "Кукуруза товарная"
-    - Если культура определена "Кукуруза" и есть слово "cилос", СТРОГО значит выбирай "Кукуруза кормовая"
-    - Если культура определена "Многолетние травы" и его тип не указан, выбирай по умолчанию "Многолетние травы текущего года"
-    - Поддерживай порядок строк исходного ввода
-    - Выводи только полные официальные названия из списка Производственный участок: {AREAS}, Операции: {OPERATIONS}, Культура {CULTURE_RULES}
-    - Никаких дополнительных комментариев, только дата (если есть), список и числа для га
-    - Никаких процентов
-    - га имеет только числовые значение
-    - если числовое значение га имеет четыре символа, то строго добавь символ запятого после первого символа числового значения га, например число значение га "1234га" строго брать как "1,234"
-
-    4. ОСОБЫЕ указания:
-    - Игнорируй любые культуры, которых нет в списке {CULTURE_RULES}
-    - Игнорируй любые операции, которых нет в списке {OPERATIONS}
-    - Сохраняй оригинальные названия из списка (кормовая, сахарная и т.д.)
-    - Учитывай падежи и сокращения: "сои" → "Соя товарная", "к.корм" → "Кукуруза кормовая"
-    
-
-    Пример преобразований для производственного участка с другими данными:
-    [Ввод]     -> [Вывод]
-    Восход Посев кук-24/252га24% -> Восход; Сев; Кукуруза товарная; 24; 252
-    Предпосевная культ Под кук-94/490га46% -> Восход; Предпосевная культивация; Кукуруза товарная; 94; 490
-    Пахота зяби под мн тр По Пу 26/488 -> АОР; Пахота; Многолетние травы текущего года; 26; 488
-
-    Примеры преобразований для операций:
-    [Ввод]     -> [Вывод]
-    СЗР        -> Гербицидная обработка
-
-    Примеры преобразований для культур:
-    [Ввод]     -> [Вывод]
-    соя        -> Соя товарная
-    кук        -> Кукуруза товарная
-    кук сил    -> Кукуруза кормовая
-    кукуруза на зерно -> Кукуруза товарная
-    гор        -> Горох товарный
-    пшеница    -> Пшеница озимая товарная
-    ячмень     -> Ячмень товарный
-    сах        -> Свекла сахарная
-    оз пш      -> Пшеница озимая товарная
-    подсол     -> Подсолнечник товарный
-    мн тр      -> Многолетние травы текущего года
-
-    Примеры преобразований для культур, га вспаханные за день и га с начала операции:
-    [Ввод]                     -> [Вывод]
-    под сою 24/252га24%                -> Соя товарная; 24; 252
-    под сою 152га , 100%               -> Соя товарная; 152; 152
-    под сою 53/1816                    -> Соя товарная; 53; 1,816
-    под сою 53/181                     -> Соя товарная; 53; 181
-    под сою 1523га , 100%              -> Соя товарная; 1,523; 1,523
-    под сою 1523га , (100%)              -> Соя товарная; 1,523; 1,523
-    под кукурузу 131га 3% Остаток 448 га Осадки 1мм -> Кукуруза товарная; 131; 131
-    под кукурузу 131га (3%) Остаток 448 га Осадки 1мм -> Кукуруза товарная; 131; 131
-    под сою 152га , 100% Остаток 448 га Осадки 1мм              -> Соя товарная; 152; 152
-    под мн тр По Пу 26га -> Многолетние травы текущего года; 26; 26
-    под подсолнечник: День - 50 га От начала - 1260 га (30%) Остаток - 2923 га -> Подсолнечник товарный; 50; 1260
-    под мн тр По Пу 26/488 Отд 12 26/221 -> Многолетние травы текущего года; 26; 488
-    
-    Примеры преобразований для производственного участка, операций, культур, га вспаханные за день и га с начала операции:
-    [Ввод]                     -> [Вывод]
-    Предп культ под оз пш По Пу 91/1403 Отд 11 45/373 Отд 12 46/363 -> АОР; Предпосевная культивация; Пшеница озимая товарная; 91; 1403
-    Внесение мин удобрений под оз пшеницу 2025 г ПУ Юг 149/7264 Отд 17-149/1443 -> АОР; Внесение минеральных удобрений; Пшеница озимая товарная; 149; 7264
-    2-е диск сои под оз пш По Пу 82/1989 Отд 11 82/993 -> АОР; Дискование 2-е; Пшеница озимая товарная; 82; 1989
-    диск сах св По Пу 70/1004 Отд 17 70/302 -> АОР; Дискование; Свекла сахарная; 70; 1004
-
-    "Каждый отдельный отчет должен быть на новой строки без дополнительных символов\n"
-    "Пример многострочного вывода:\n"
-    "12.12.2024; Восход; Сев. Кукуруза товарная; 24; 252\n"
-    "Восход; Пахота; Подсолнечник товарный; 150; 300\n"
-    "12.12; Центр; Обработка; Соя товарная; 75; 400"
-    
-    Итоговый ответ должен быть строго таков: Дата; Производственный участок; Операция; Культура; За день; С начала операции
+def load_vocabulary():
+    """Перечитывает словари участков, операций и культур и пересобирает локальный разборщик"""
+    global AREAS, OPERATIONS, CULTURE_RULES, CULTURES, fast_parser
+    AREAS = load_areas()
+    OPERATIONS = load_operations()
+    CULTURE_RULES = load_culture_rules()
+    CULTURES = [line.strip() for line in CULTURE_RULES.splitlines() if line.strip()]
+    
+    # Локальный разбор типовых отчетов без обращения к YandexGPT
+    fast_parser = FastParser(AREAS, OPERATIONS, CULTURES)
+    return AREAS, OPERATIONS, CULTURES
+
+# Промпт собирается при запуске и пересобирается только при изменении файлов словарей
+fast_parser = None
+prompt_store = PromptStore(VOCABULARY_FILES, load_vocabulary)
+fast_path_stats = FastPathStats()
+token_usage = TokenUsage()
+
+async def expand_abbreviations(text: str, max_tokens: int = 2000, stream: CompletionStream = None) -> LLMResult:
+    """Расшифровка через YandexGPT; короткие сообщения сначала идут в YandexGPT Lite"""
+    if stream is not None or model_router is None:
+        # Потоковые строки фиксируются по мере генерации, повторить запрос в другой модели нельзя
+        return await request_completion(text, MODEL_URI, max_tokens, stream)
+    return await model_router.expand(text, max_tokens)
+
+def validate_expansion(text: str):
+    """Причина, по которой ответ Lite не принимается; None - ответ можно принять.
+
+    Строки проверяются так же, как при разборе (parse_line), а участок, операция
+    и культура - по текущим словарям. Пустой ответ и флуд-строки принимаются как
+    есть: полная модель их не исправит, а parse_line учтет их как обычно.
     """
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    for line in lines:
+        parts = [part.strip() for part in line.split(';')]
+        if is_flood(parts):
+            continue
+        _, fields, error = split_row(parts)
+        if error is not None:
+            return f"{error} в строке «{line}»"
+        area, operation, culture = fields[:3]
+        if area not in AREAS:
+            return f"участок «{area}» не из словаря"
+        if operation not in OPERATIONS:
+            return f"операция «{operation}» не из словаря"
+        if culture not in CULTURES:
+            return f"культура «{culture}» не из словаря"
+    return None
 
-    headers = {
-        "Authorization": f"Bearer {current_iam_token}",
-        "Content-Type": "application/json"
-    }
+async def post_with_iam(service: str, url: str, data: dict, observe, headers: dict = None, **kwargs):
+    """POST к API Yandex Cloud с IAM-токеном; None - токена нет.
+
+    Если API отклонил токен (401), токен обновляется один раз и запрос повторяется.
+    observe(seconds, result) учитывает время каждого запроса, остальные аргументы
+    передаются в api_client.post_json.
+    """
+    token = iam_tokens.token
+    if not token:
+        return None
+    for attempt in range(2):
+        request_headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            **(headers or {})
+        }
+        started = time.perf_counter()
+        result = await api_client.post_json(url, data, headers=request_headers, **kwargs)
+        observe(time.perf_counter() - started, result)
+        if result.status != 401 or attempt:
+            break
+        # Токен отозван или истек раньше срока: обновляем один раз и повторяем запрос
+        logger.warning(f"{service} отклонил IAM-токен, получаем новый")
+        token = await iam_tokens.refresh(stale=token)
+        if not token:
+            break
+    return result
+
+async def request_completion(text: str, model_uri: str = MODEL_URI, max_tokens: int = 2000,
+                             stream: CompletionStream = None) -> LLMResult:
+    system_prompt = prompt_store.text
     
     data = {
-        "modelUri": f"gpt://{YC_FOLDER_ID}/yandexgpt",
+        "modelUri": model_uri,
         "completionOptions": {
             "temperature": 0.3,
-            "maxTokens": 2000
+            "maxTokens": max_tokens
         },
         "messages": [
             {"role": "system", "text": system_prompt},
@@ -328,45 +322,250 @@ async def expand_abbreviations(text: str) -> str:
         ]
     }
     
+    if stream is not None:
+        data["completionOptions"]["stream"] = True
+    
+    model = model_uri.rsplit("/", 1)[-1]
+    result = await post_with_iam(
+        "YandexGPT", COMPLETION_URL, data,
+        lambda seconds, result: LLM_REQUEST_SECONDS.observe(seconds, model=model, result="ok" if result.ok else "error"),
+        limiter=limiters["yandexgpt"], tokens=estimate_tokens(system_prompt + text),
+        on_data=stream.feed if stream is not None else None
+    )
+    if result is None:
+        return LLMResult(error="IAM-токен не инициализирован")
+    
+    if not result.ok:
+        logger.error(f"API error: {result.status} - {result.error}")
+        return LLMResult(error=f"YandexGPT вернул ошибку {result.status}")
+    
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-                headers=headers,
-                json=data,
-                timeout=30
-            ) as response:
-                
-                if response.status != 200:
-                    error = await response.text()
-                    logger.error(f"API error: {response.status} - {error}")
-                    return "Ошибка обработки запроса"
-                
-                result = await response.json()
-                return result['result']['alternatives'][0]['message']['text']
-                
-    except Exception as e:
-        logger.error(f"Ошибка: {str(e)}")
-        return "Ошибка при обработке запроса"
+        response = result.data['result']
+        expanded_text = response['alternatives'][0]['message']['text']
+    except (KeyError, IndexError, TypeError) as e:
+        logger.error(f"Неожиданный формат ответа YandexGPT: {str(e)}")
+        return LLMResult(error="Неожиданный формат ответа YandexGPT")
+    
+    # Учет токенов по полю usage ответа
+    usage = response.get('usage', {})
+    input_tokens = int(usage.get('inputTextTokens', 0))
+    output_tokens = int(usage.get('completionTokens', 0))
+    token_usage.add(input_tokens, output_tokens)
+    LLM_TOKENS.inc(input_tokens, direction="input")
+    LLM_TOKENS.inc(output_tokens, direction="output")
+    logger.info(
+        f"YandexGPT: входных токенов {input_tokens}, выходных {output_tokens} "
+        f"(всего за сессию: {token_usage.input_tokens}/{token_usage.output_tokens} за {token_usage.requests} запросов)"
+    )
+    return LLMResult(text=expanded_text, input_tokens=input_tokens, output_tokens=output_tokens)
 
-router = Router()
+async def recognize_text(image: bytes) -> OcrResult:
+    """Распознает текст подготовленного фото отчета через Yandex Vision OCR"""
+    data = {
+        "mimeType": "PNG",
+        "languageCodes": ["ru"],
+        "model": "page",
+        "content": base64.b64encode(image).decode("ascii")
+    }
+    
+    result = await post_with_iam(
+        "Yandex Vision", OCR_URL, data,
+        lambda seconds, result: OCR_REQUEST_SECONDS.observe(seconds, result="ok" if result.ok else "error"),
+        headers={"x-folder-id": YC_FOLDER_ID}, limiter=limiters["vision"]
+    )
+    if result is None:
+        return OcrResult(error="IAM-токен не инициализирован")
+    
+    if not result.ok:
+        logger.error(f"OCR error: {result.status} - {result.error}")
+        return OcrResult(error=f"Yandex Vision вернул ошибку {result.status}")
+    
+    try:
+        text = result.data['result']['textAnnotation']['fullText']
+    except (KeyError, TypeError) as e:
+        logger.error(f"Неожиданный формат ответа Yandex Vision: {str(e)}")
+        return OcrResult(error="Неожиданный формат ответа Yandex Vision")
+    return OcrResult(text=text)
+
+async def expand_report(text: str, on_line=None) -> LLMResult:
+    """Расшифровывает отчет: типовые строки локально, остальные через YandexGPT.
 
-async def write_to_sheet(data: list):
+    Если передан on_line, готовые строки передаются в него в итоговом порядке:
+    локальные строки до ответа модели - сразу, строки модели - по мере генерации.
+    """
+    parsed = fast_parser.parse(text)
+    fast_path_stats.record(parsed)
+    logger.info(
+        f"Локально разобрано строк: {parsed.resolved_count}, передано в YandexGPT: {len(parsed.unresolved)} "
+        f"(доля локального разбора: {fast_path_stats.hit_rate:.0%})"
+    )
+    
+    stream = CompletionStream(on_line) if on_line is not None else None
+    slot = parsed.lines.index(None) if parsed.unresolved else len(parsed.lines)
+    if stream is not None:
+        for line in parsed.lines[:slot]:
+            await on_line(line)
+    
+    llm_text = ""
+    if parsed.unresolved:
+        if prompt_store.refresh():
+            llm_cache.vocabulary_fingerprint = fingerprint(MODEL_URI, prompt_store.fingerprint)
+        
+        llm_input = parsed.llm_input()
+        if stream is not None:
+            complete = lambda: expand_abbreviations(llm_input, stream=stream)
+        elif llm_batcher is not None:
+            complete = lambda: llm_batcher.expand(llm_input)
+        else:
+            complete = lambda: expand_abbreviations(llm_input)
+        expansion = await llm_cache.get_or_compute(llm_input, complete)
+        stats = llm_cache.stats
+        logger.info(
+            f"Кэш YandexGPT: память {stats.memory_hits}, диск {stats.disk_hits}, "
+            f"объединено {stats.coalesced}, промахов {stats.misses} (доля попаданий: {stats.hit_rate:.0%})"
+        )
+        if not expansion.ok:
+            if stream is not None:
+                # Строки до ответа модели уже переданы: локальные строки после него
+                # тоже передаются, чтобы обрыв ответа не терял их
+                for line in parsed.lines[slot + 1:]:
+                    await on_line(line)
+            return expansion
+        llm_text = expansion.text
+    
+    if stream is not None:
+        # При попадании в кэш ответ модели приходит целиком, а не потоком
+        stream.text = llm_text
+        await stream.finish()
+        for line in parsed.lines[slot + 1:]:
+            await on_line(line)
+    return LLMResult(text=parsed.merge(llm_text))
+
+# Локальная копия строк таблицы для сводок и проверки итогов "С начала операции"
+report_store = ReportStore()
+report_store_buffer = None  # строки, записанные, пока копия строится
+duplicate_index = DuplicateIndex(DUPLICATE_INDEX_DAYS)
+
+def on_rows_written(rows: list):
+    """Вызывается буфером записи после каждой успешной записи в таблицу"""
+    duplicate_index.add_rows(rows)
+    if report_store_buffer is not None:
+        report_store_buffer.extend(rows)
+    elif report_store.loaded:
+        report_store.add_rows(rows)
+
+async def load_report_store():
+    """Восстанавливает локальную копию одним чтением листа"""
+    global report_store, report_store_buffer
     try:
-        sheet.append_row(data)
-        return True
+        values = await sheet_sink.read_all()
     except Exception as e:
-        logger.error(f"Ошибка записи в таблицу: {str(e)}")
-        return False
+        logger.error(f"Не удалось прочитать таблицу для локальной копии: {str(e)}")
+        return
+    # Чтение и запись идут через один слот ограничителя Sheets: всё записанное раньше уже в values,
+    # а строки, записанные дальше, копятся в буфере, пока копия строится в отдельном потоке
+    report_store_buffer = []
+    try:
+        store = ReportStore()
+        index = DuplicateIndex(DUPLICATE_INDEX_DAYS)
+        await asyncio.to_thread(store.rebuild, values)
+        await asyncio.to_thread(index.add_rows, values)
+        store.add_rows(report_store_buffer)
+        report_store = store
+        # Строки, зафиксированные за время чтения, в индексе уже есть: дополняем, а не заменяем
+        duplicate_index.merge(index)
+        logger.info(f"Индекс повторов загружен: {len(duplicate_index)} строк")
+    finally:
+        report_store_buffer = None
+
+async def wait_duplicate_index():
+    """Ждет первой загрузки индекса повторов, чтобы строки не сверялись с пустым индексом"""
+    task = report_store_task
+    if task is None or task.done():
+        return
+    done, _ = await asyncio.wait({task}, timeout=DUPLICATE_INDEX_WAIT)
+    if not done:
+        logger.warning(f"Индекс повторов не загружен за {DUPLICATE_INDEX_WAIT} с, строки сверяются с неполным индексом")
+
+async def deliver_new_rows(rows: list) -> int:
+    """Доставка очереди записи в режиме вебхука: строки, уже записанные в таблицу, пропускаются.
+
+    Процессы-обработчики таблицу не читают, поэтому повторы из разных процессов
+    отсеиваются здесь, в основном процессе, перед обращением к Sheets API.
+    """
+    await wait_duplicate_index()
+    fresh, seen = [], set()
+    for row in rows:
+        fingerprint = row_fingerprint(row)
+        if fingerprint is not None and (duplicate_index.contains(row) or fingerprint in seen):
+            logger.info(f"Строка уже есть в таблице, пропускаем: {'; '.join(row)}")
+            REPORT_LINES.inc(result="duplicate")
+            continue
+        seen.add(fingerprint)
+        fresh.append(row)
+    if not fresh:
+        return len(rows)
+    written = await sheet_sink.write_rows(fresh)
+    return len(rows) if written == len(fresh) else 0
+
+SUMMARY_COMMAND_RE = re.compile(r"^/summary(@\w+)?(\s|$)")
+DATE_ARGUMENT_RE = re.compile(r"^\d{1,2}[./]\d{1,2}([./]\d{2,4})?$")
+
+def summary_text(command: str) -> str:
+    """Ответ на /summary [дата] [операция]; без даты - за сегодня"""
+    if not report_store.loaded:
+        return "⏳ Сводка пока недоступна: данные таблицы еще загружаются"
+    
+    parts = command.split(maxsplit=1)
+    arguments = parts[1].strip() if len(parts) > 1 else ""
+    day = date.today()
+    first, _, rest = arguments.partition(" ")
+    if DATE_ARGUMENT_RE.match(first):
+        try:
+            day = datetime.strptime(parse_date(first), "%d/%m/%Y").date()
+        except ValueError:
+            return f"❌ Некорректная дата: {first}"
+        arguments = rest.strip()
+    
+    operation = None
+    if arguments:
+        operation = next(
+            (value for value in report_store.operations.values if value.lower() == arguments.lower()), None
+        )
+        if operation is None:
+            return f"❌ Операция «{arguments}» в таблице не найдена"
+    
+    rows = report_store.summary(day, operation)
+    title = f"📊 Сводка за {day:%d/%m/%Y}" + (f" ({operation})" if operation else "")
+    if not rows:
+        return f"{title}\nЗаписей нет"
+    lines = [title]
+    for row in sorted(rows, key=lambda row: (row["operation"], row["area"], row["culture"])):
+        total = f", с начала {row['total_ha']:g} га" if row["total_ha"] is not None else ""
+        lines.append(f"{row['area']} · {row['operation']} · {row['culture']}: за день {row['day_ha']:g} га{total}")
+    lines.append(f"Итого за день: {sum(row['day_ha'] for row in rows):g} га")
+    return "\n".join(lines)
+
+def answer_webhook_command(update: dict):
+    """В режиме вебхука /summary отвечает основной процесс, где хранится копия таблицы"""
+    message = update.get("message") or {}
+    text = message.get("text") or ""
+    if not SUMMARY_COMMAND_RE.match(text):
+        return None
+    return {"method": "sendMessage", "chat_id": message["chat"]["id"], "text": summary_text(text)}
+
+router = Router()
 
-def parse_date(date_str: str) -> str:
-    """Парсит дату в формате DD/MM или DD/MM/YY и возвращает в формате DD/MM/YYYY"""
-    # Если дата 00.00.00, возвращаем текущую дату
+def parse_date(date_str: str, today: datetime = None) -> str:
+    """Парсит дату в формате DD/MM или DD/MM/YY и возвращает в формате DD/MM/YYYY;
+    today - дата отчета по умолчанию (по умолчанию текущая)"""
+    today = today or datetime.now()
+    # Если дата 00.00.00, возвращаем дату отчета
     if date_str.strip() == "00.00.00":
-        return datetime.now().strftime("%d/%m/%Y")
+        return today.strftime("%d/%m/%Y")
     
     if not date_str.strip():
-        return datetime.now().strftime("%d/%m/%Y")
+        return today.strftime("%d/%m/%Y")
     
     try:
         # Удаляем возможные точки и заменяем на слеши
@@ -375,7 +574,7 @@ def parse_date(date_str: str) -> str:
         parts = date_str.split("/")
         if len(parts) == 2:  # DD/MM
             day, month = parts
-            year = datetime.now().year
+            year = today.year
             return f"{int(day):02d}/{int(month):02d}/{year}"
         elif len(parts) == 3:  # DD/MM/YY
             day, month, year = parts
@@ -385,162 +584,571 @@ def parse_date(date_str: str) -> str:
                 year = 2000 + year
             return f"{int(day):02d}/{int(month):02d}/{year}"
         else:
-            return datetime.now().strftime("%d/%m/%Y")
+            return today.strftime("%d/%m/%Y")
     except (ValueError, IndexError):
-        return datetime.now().strftime("%d/%m/%Y")
+        return today.strftime("%d/%m/%Y")
 
-@router.message(F.content_type == "text")
-async def handle_message(message: Message):
-    global message_counters
-    
-    # Сохраняем оригинальное сообщение
-    original_text = message.text
-    is_flood = False  # Флаг для определения флуда
+@dataclass
+class ReportJob:
+    """Сообщение с отчетом и результаты его обработки на этапах конвейера"""
+    message: Message
+    text: str
+    user_id: int
+    first_name: str
+    message_key: str = ""  # "чат:сообщение", основа ключей идемпотентности строк
+    message_number: int = 0
+    lines: list = field(default_factory=list)
+    pending_rows: list = field(default_factory=list)  # (номер строки, данные) для пакетной записи
+    successful: int = 0
+    errors: int = 0
+    error_details: list = field(default_factory=list)
+    flood_lines: int = 0
+    is_flood: bool = False
+    warnings: list = field(default_factory=list)  # подозрительные, но записанные строки
+    duplicates: list = field(default_factory=list)  # номера строк, уже записанных в таблицу
+    checked_rows: int = 0  # сколько строк pending_rows уже сверено с индексом повторов
+    streamed: bool = False  # строки уже разобраны по мере генерации ответа
+    trace_id: str = field(default_factory=new_trace_id)
+    sent_at: datetime = field(default_factory=datetime.now)  # дата строк отчета без даты
+
+def drop_duplicates(job: ReportJob):
+    """Убирает из еще не сверенных строк задания те, что уже записаны в таблицу или в этом сообщении"""
+    fresh = job.pending_rows[:job.checked_rows]
+    for i, row in job.pending_rows[job.checked_rows:]:
+        if duplicate_index.add(row):
+            fresh.append((i, row))
+        else:
+            job.duplicates.append(i)
+    job.pending_rows = fresh
+    job.checked_rows = len(fresh)
+
+EMPTY_VALUES = ('—', '-', '–', '−')
+
+def is_flood(parts: list) -> bool:
+    """Проверка на флуд: прочерк в одном из полей строки"""
+    return len(parts) >= 3 and any(part in EMPTY_VALUES for part in parts)
+
+def split_row(parts: list) -> tuple:
+    """Поля строки ответа модели: (дата из ответа или None, [участок, операция, культура,
+    за день, всего], причина, по которой строку нельзя записать, или None)"""
+    # Проверяем количество компонентов
+    if len(parts) < 5:
+        return None, parts, f"Неверное количество элементов ({len(parts)} вместо 5-6)"
     
-    # Увеличиваем счетчик только один раз для всего сообщения
-    user_id = message.from_user.id
-    message_counters[user_id] += 1
-    save_counters()
+    # Проверяем, является ли первая часть датой (содержит разделитель)
+    date_part = None
+    if "." in parts[0]:
+        date_part, parts = parts[0], parts[1:]
     
-    # Обработка сообщения
-    expanded_text = await expand_abbreviations(original_text)
-    print(expanded_text)
+    # Проверяем, есть ли достаточно частей для всех данных
+    if len(parts) < 5:
+        return date_part, parts, "Недостаточно данных после определения даты"
     
-    # Разделяем ответ на отдельные строки
-    lines = [line.strip() for line in expanded_text.split('\n') if line.strip()]
+    # Дополнительная проверка на пустые значения
+    fields = parts[:5]
+    if any(val in EMPTY_VALUES + ('',) for val in fields[:3]):
+        return date_part, fields, "Обнаружены пустые значения в основных полях"
+    return date_part, fields, None
+
+def parse_line(job: ReportJob, i: int, line: str):
+    """Проверяет строку ответа модели и добавляет ее в очередь записи задания"""
+    parts = [part.strip() for part in line.split(';')]
     
-    successful = 0
-    errors = 0
-    error_details = []
-    total_flood_lines = 0  # Счетчик флуд-строк
+    if is_flood(parts):
+        job.flood_lines += 1
+        job.error_details.append(f"Строка {i}: Обнаружен флуд-формат")
+        job.errors += 1
+        return
     
-    # Обрабатываем каждую строку отдельно
-    for i, line in enumerate(lines, 1):
-        parts = [part.strip() for part in line.split(';')]
-        
-        # Проверка на флуд: если больше двух "-"
-        flood_indicator = any(
-            part.strip() in ('—', '-', '–', '−')
-            for part in parts
-        )
-        
-        if flood_indicator and len(parts) >= 3:
-            total_flood_lines += 1
-            error_details.append(f"Строка {i}: Обнаружен флуд-формат")
-            errors += 1
-            continue
+    try:
+        date_part, fields, error = split_row(parts)
+        if error is not None:
+            job.error_details.append(f"Строка {i}: {error}")
+            job.errors += 1
+            if len(parts) < 5:
+                print(parts)
+            return
         
-        # Проверяем количество компонентов
-        if len(parts) < 5:
-            error_details.append(f"Строка {i}: Неверное количество элементов ({len(parts)} вместо 5-6)")
-            errors += 1
-            print(parts)
-            continue
+        # Формируем данные для записи: дата из сообщения или дата отправки,
+        # участок, операция, культура, за день, всего
+        date_str = parse_date(date_part, job.sent_at) if date_part else job.sent_at.strftime("%d/%m/%Y")
+        report_data = [date_str] + fields
         
-        try:
-            # Пытаемся определить дату из первой части
-            date_str = ""
-            unit_part = 0
-            culture_part = 2
-            
-            # Проверяем, является ли первая часть датой (содержит разделитель)
-            if "." in parts[0]:
-                date_str = parse_date(parts[0])
-                unit_part = 1
-                culture_part = 3
-            else:
-                date_str = datetime.now().strftime("%d/%m/%Y")
-                unit_part = 0
-                culture_part = 2
-            
-            # Проверяем, есть ли достаточно частей для всех данных
-            if len(parts) < culture_part + 2:
-                error_details.append(f"Строка {i}: Недостаточно данных после определения даты")
-                errors += 1
-                continue
-            
-            # Формируем данные для записи
-            report_data = [
-                date_str,  # Дата из сообщения или текущая
-                parts[unit_part],    # Производственный участок
-                parts[unit_part+1],  # Операция
-                parts[culture_part],  # Культура
-                parts[culture_part+1],  # За день (заменяем запятую на точку)
-                parts[culture_part+2]   # Всего (заменяем запятую на точку)
-            ]
+        job.pending_rows.append((i, report_data))
             
-            # Дополнительная проверка на пустые значения
-            if any(val in ('—', '-', '–', '−', '') for val in report_data[1:4]):
-                error_details.append(f"Строка {i}: Обнаружены пустые значения в основных полях")
-                errors += 1
-                continue
-            
-            # Запись в таблицу
-            if await write_to_sheet(report_data):
-                successful += 1
-            else:
-                errors += 1
-                error_details.append(f"Строка {i}: Ошибка записи в таблицу")
-                
-        except ValueError as e:
-            errors += 1
-            error_details.append(f"Строка {i}: Ошибка преобразования чисел - {str(e)}")
-        except Exception as e:
-            errors += 1
-            error_details.append(f"Строка {i}: Неизвестная ошибка - {str(e)}")
-            logger.error(f"Ошибка в строке {i}: {str(e)}")
+    except ValueError as e:
+        job.errors += 1
+        job.error_details.append(f"Строка {i}: Ошибка преобразования чисел - {str(e)}")
+    except Exception as e:
+        job.errors += 1
+        job.error_details.append(f"Строка {i}: Неизвестная ошибка - {str(e)}")
+        logger.error(f"Ошибка в строке {i}: {str(e)}")
+
+def format_result(job: ReportJob) -> str:
+    result_message = f"✅ Успешно записано: {job.successful}\n❌ Ошибок: {job.errors}"
+    if job.duplicates:
+        lines = ", ".join(str(i) for i in job.duplicates)
+        result_message += f"\n🔁 Пропущено повторов: {len(job.duplicates)} (строки {lines} уже есть в таблице)"
+    if job.error_details:
+        result_message += "\n\nДетали ошибок:\n" + "\n".join(job.error_details)
+    if job.warnings:
+        result_message += "\n\n⚠️ Проверьте:\n" + "\n".join(job.warnings)
+    return result_message
+
+async def stage_expand(job: ReportJob):
+    """Этап 1: счетчик сообщений и расшифровка сокращений"""
+    # Повторно доставленное сообщение уже зафиксировано: отвечаем сохраненным итогом без YandexGPT
+    previous = await outbox.processed(job.message_key)
+    if previous is not None:
+        logger.info(f"Сообщение {job.message_key} уже обработано, повторный запрос к YandexGPT не нужен")
+        job.successful = previous["successful"]
+        job.errors = previous["errors"]
+        job.error_details = previous["error_details"]
+        job.warnings = previous.get("warnings", [])
+        job.duplicates = previous.get("duplicates", [])
+        print(format_result(job))
+        return None
+    
+    # Увеличиваем счетчик только один раз для всего сообщения
+    job.message_number = await counter_store.increment(job.user_id)
+    
+    on_line = None
+    if LLM_STREAMING:
+        job.streamed = True
+        started = time.perf_counter()
+        
+        async def on_line(line: str):
+            # Строка проверяется теми же правилами, что и на этапе разбора, и сразу фиксируется
+            if not job.lines:
+                FIRST_ROW_SECONDS.observe(time.perf_counter() - started)
+            job.lines.append(line)
+            committed = len(job.pending_rows)
+            parse_line(job, len(job.lines), line)
+            await wait_duplicate_index()
+            drop_duplicates(job)
+            rows = [(f"{job.message_key}:{i}", row) for i, row in job.pending_rows[committed:]]
+            if rows:
+                try:
+                    await outbox.commit(job.message_key, rows)
+                except Exception as e:
+                    # Строка останется в задании и будет зафиксирована на этапе записи
+                    logger.error(f"Ошибка сохранения строки в очередь записи: {str(e)}")
+    
+    expansion = await expand_report(job.text, on_line)
+    if not expansion.ok:
+        if job.pending_rows:
+            # Часть строк потокового ответа уже зафиксирована: сообщаем о них и об обрыве
+            job.errors += 1
+            job.error_details.append(f"Ответ YandexGPT прерван: {expansion.error}")
+            return job
+        # Ошибку API не разбираем как строки отчета
+        print(f"❌ Ошибка обработки запроса: {expansion.error}")
+        return None
+    
+    print(expansion.text)
+    
+    # Разделяем ответ на отдельные строки
+    if not job.streamed:
+        job.lines = [line.strip() for line in expansion.text.split('\n') if line.strip()]
+    return job
+
+async def stage_parse(job: ReportJob):
+    """Этап 2: разбор и проверка строк"""
+    if job.streamed:
+        return job
+    
+    started = time.perf_counter()
+    # Обрабатываем каждую строку отдельно
+    for i, line in enumerate(job.lines, 1):
+        parse_line(job, i, line)
+    PARSE_SECONDS.observe(time.perf_counter() - started)
+    return job
+
+async def stage_write(job: ReportJob):
+    """Этап 3: фиксация строк в локальной очереди записи в таблицу"""
+    # Повторы отсеиваются до любых обращений к API и не считаются ни успехом, ни ошибкой
+    await wait_duplicate_index()
+    drop_duplicates(job)
+    job.successful += len(job.pending_rows)
     
     # Проверка на полный флуд (все строки флуд)
-    if total_flood_lines >= len(lines) and len(lines) > 0:
-        is_flood = True
-        successful = 0
-        errors = len(lines)
-        error_details.append("Обнаружен полный флуд во всех строках")
+    if job.flood_lines >= len(job.lines) and len(job.lines) > 0:
+        job.is_flood = True
+        job.successful = 0
+        job.errors = len(job.lines)
+        job.error_details.append("Обнаружен полный флуд во всех строках")
+    
+    # Итог "С начала операции" не должен уменьшаться относительно уже записанных строк
+    job.warnings = report_store.check_totals([row for _, row in job.pending_rows])
     
+    # Пользователь получает ответ после локальной фиксации; в таблицу строки доставит outbox
+    rows = [(f"{job.message_key}:{i}", row) for i, row in job.pending_rows]
+    summary = {
+        "successful": job.successful, "errors": job.errors,
+        "error_details": job.error_details, "warnings": job.warnings, "duplicates": job.duplicates
+    }
+    try:
+        await outbox.commit(job.message_key, rows, summary)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения строк в очередь записи: {str(e)}")
+        for _, row in job.pending_rows:
+            duplicate_index.discard(row)
+        job.successful -= len(job.pending_rows)
+        job.errors += len(job.pending_rows)
+        job.error_details.extend(
+            f"Строка {i}: Ошибка записи в таблицу" for i, _ in job.pending_rows
+        )
+    return job
+
+async def stage_archive(job: ReportJob):
+    """Этап 4: архивация исходного сообщения и итоговый отчет"""
     # Формируем итоговый отчет
-    result_message = f"✅ Успешно записано: {successful}\n❌ Ошибок: {errors}"
-    if error_details:
-        result_message += "\n\nДетали ошибок:\n" + "\n".join(error_details)
+    result_message = format_result(job)
     
     # Сохранение в Google Drive
-    if successful > 0 and not is_flood:
+    if job.successful > 0 and not job.is_flood:
         now = datetime.now()
         filename_time = now.strftime("%M%H%d%m%Y")
-        filename = f"{message.from_user.first_name}_{message_counters[user_id]}_{filename_time}"
+        filename = f"{job.first_name}_{job.message_number}_{filename_time}"
+        
+        # Номер в имени файла должен пережить перезапуск бота
+        await counter_store.flush()
         
-        success = await save_to_drive(
-            content=original_text,
+        # Архивация идет в фоне, ответ пользователю ее не ждет
+        drive_archiver.submit(
+            content=job.text,
             filename=f"{filename}.doc",
             folder_id=GOOGLE_DRIVE_FOLDER_ID
         )
-        
-        if not success:
-            result_message += "\n\n⚠️ Не удалось сохранить в Google Drive"
+    
+    REPORT_LINES.inc(job.successful, result="success")
+    REPORT_LINES.inc(max(0, job.errors - job.flood_lines), result="error")
+    REPORT_LINES.inc(job.flood_lines, result="flood")
+    REPORT_LINES.inc(len(job.duplicates), result="duplicate")
     
     # Сбрасываем счетчик если обнаружен флуд
-    if is_flood:
-        message_counters[user_id] -= 1
-        save_counters()
+    if job.is_flood:
+        await counter_store.decrement(job.user_id)
     
     # Отправляем результат
-    # await message.answer(result_message)
+    # await job.message.answer(result_message)
     print(result_message)
+    return None
 
-async def main():
-    # Инициализируем токен при старте
-    global current_iam_token
-    current_iam_token = await get_new_iam_token()
+@router.message(Command("summary"))
+async def handle_summary(message: Message):
+    # Сводка считается по локальной копии таблицы, без чтения Google Sheets
+    await message.answer(summary_text(message.text))
+
+async def download_photo(message: Message) -> bytes:
+    """Загружает самый крупный размер фото потоком, частями по 64 КБ"""
+    destination = io.BytesIO()
+    await message.bot.download(message.photo[-1], destination=destination)
+    return destination.getvalue()
+
+async def recognize_photo(message: Message):
+    """Распознает фото отчета и ставит полученный текст в конвейер, как обычное сообщение"""
+    job = ReportJob(
+        message=message,
+        text="",
+        user_id=message.from_user.id,
+        first_name=message.from_user.first_name,
+        message_key=f"{message.chat.id}:{message.message_id}"
+    )
+    # Повторно доставленное фото не распознается снова: итог ответит этап расшифровки
+    if await outbox.processed(job.message_key) is None:
+        result = await photo_processor.process(message.photo[-1].file_size, lambda: download_photo(message))
+        if not result.ok:
+            print(f"❌ Ошибка распознавания фото: {result.error}")
+            return
+        if not result.text.strip():
+            print("❌ На фото не найден текст отчета")
+            return
+        # Подпись к фото (например, дата) идет перед распознанной таблицей
+        job.text = "\n".join(part for part in (message.caption, result.text) if part)
+    await pipeline.submit(job)
+
+@router.message(F.photo)
+async def handle_photo(message: Message):
+    # Фото распознается в фоне, чтобы не задерживать прием остальных сообщений
+    task = asyncio.create_task(recognize_photo(message))
+    photo_tasks.add(task)
+    task.add_done_callback(photo_tasks.discard)
+
+@router.message(F.content_type == "text")
+async def handle_message(message: Message):
+    # Обработчик только ставит сообщение в конвейер; если очереди заполнены, ждет
+    await pipeline.submit(ReportJob(
+        message=message,
+        text=message.text,
+        user_id=message.from_user.id,
+        first_name=message.from_user.first_name,
+        message_key=f"{message.chat.id}:{message.message_id}"
+    ))
+
+def register_gauges():
+    """Глубина очередей снимается в момент запроса метрик"""
+    def pipeline_depths():
+        values = {}
+        for stage, depth in pipeline.depths().items():
+            values[(stage, "queued")] = depth["queued"]
+            values[(stage, "in_flight")] = depth["in_flight"]
+        return values
+    
+    if pipeline is not None:
+        REGISTRY.gauge("agro_pipeline_jobs", "Задания на этапах конвейера", ("stage", "state"), pipeline_depths)
+    if outbox is not None and outbox.deliver is not None:
+        REGISTRY.gauge("agro_outbox_pending", "Строки, еще не доставленные в таблицу", collect=lambda: outbox.pending)
+    if sheet_sink is not None:
+        REGISTRY.gauge("agro_sheet_pending", "Пачки строк в буфере записи в таблицу", collect=lambda: sheet_sink.pending)
+    if photo_processor is not None:
+        REGISTRY.gauge("agro_photo_buffered_bytes", "Загруженные фото, ожидающие подготовки",
+                       collect=lambda: photo_processor.buffered)
+    if drive_archiver is not None:
+        REGISTRY.gauge("agro_drive_pending", "Файлы в очереди загрузки в Google Drive", collect=lambda: drive_archiver.pending)
+    REGISTRY.gauge("agro_rate_limit", "Текущий лимит параллельности внешних API", ("api",),
+                   lambda: {(name,): limiter.limit for name, limiter in limiters.items()})
+
+def split_quota(settings: dict, parts: int) -> dict:
+    """Доля квоты внешнего API для одного из parts процессов"""
+    share = dict(settings)
+    share["requests_per_second"] = settings["requests_per_second"] / parts
+    if settings.get("tokens_per_minute"):
+        share["tokens_per_minute"] = settings["tokens_per_minute"] / parts
+    share["max_concurrency"] = max(1, settings.get("max_concurrency", 8) // parts)
+    return share
+
+async def startup(worker: bool = False) -> bool:
+    """Запускает подсистемы бота; независимые шаги выполняются параллельно.
+
+    worker - процесс-обработчик в режиме вебхука: счетчики читаются из общей
+    базы при каждом обращении, а строки только фиксируются в очереди записи,
+    в таблицу их доставляет основной процесс.
+    """
+    global api_client, llm_cache, llm_batcher, model_router, sheet_sink, counter_store, drive_archiver
+    global pipeline, outbox, metrics_runner, report_store_task, photo_processor
+    started = time.perf_counter()
+    
+    async def timed(name, step):
+        step_started = time.perf_counter()
+        try:
+            return await step
+        finally:
+            startup_timings[name] = time.perf_counter() - step_started
     
-    if not current_iam_token:
+    # Распознавание фото отчетов; текст затем идет в тот же конвейер.
+    # Пул процессов подготовки изображений создается раньше потоков остальных подсистем
+    photo_processor = PhotoProcessor(
+        recognize_text,
+        workers=PHOTO_WORKERS,
+        concurrency=PHOTO_CONCURRENCY,
+        memory_limit=PHOTO_MEMORY_LIMIT,
+        max_side=PHOTO_MAX_SIDE
+    )
+    photo_processor.start()
+    
+    # Словари читаются с локального диска, их отпечаток нужен кэшу
+    vocabulary_started = time.perf_counter()
+    prompt_store.refresh(force=True)
+    startup_timings["словари"] = time.perf_counter() - vocabulary_started
+    
+    # Общий HTTP-клиент для YandexGPT и IAM
+    api_client = ApiClient()
+    await api_client.start()
+    
+    # Кэш ответов YandexGPT, привязанный к текущим словарям и промпту
+    llm_cache = LLMCache(DATABASE_FILE, fingerprint(MODEL_URI, prompt_store.fingerprint))
+    # Счетчики сообщений загружаются из базы по мере обращения пользователей
+    counter_store = CounterStore(DATABASE_FILE, legacy_file=COUNTERS_FILE, shared=worker)
+    # Фоновая архивация исходных сообщений в Google Drive
+    drive_archiver = DriveArchiver(google.drive, lambda: google.credentials, DATABASE_FILE,
+                                   limiter=limiters["drive"])
+    if worker:
+        outbox = Outbox(DATABASE_FILE, None)
+    else:
+        # Общий буфер записи строк в Google Sheets; лист открывается при первой записи
+        sheet_sink = SheetSink(google.worksheet, limiter=limiters["sheets"], on_written=on_rows_written)
+        # Строки сначала фиксируются локально, затем доставляются в таблицу через sheet_sink
+        outbox = Outbox(DATABASE_FILE, sheet_sink.write_rows, batch_size=OUTBOX_BATCH_ROWS)
+    
+    token_ready, *_ = await asyncio.gather(
+        timed("IAM-токен", iam_tokens.start()),
+        timed("кэш YandexGPT", llm_cache.open()),
+        timed("счетчики", counter_store.open()),
+        timed("очередь архивации", drive_archiver.start()),
+        timed("очередь записи", outbox.start()),
+    )
+    if sheet_sink is not None:
+        sheet_sink.start()
+        # Копия таблицы строится в фоне и не задерживает запуск
+        report_store_task = asyncio.create_task(load_report_store())
+    if LLM_ROUTING:
+        model_router = ModelRouter(
+            request_completion, LITE_MODEL_URI, MODEL_URI, validate_expansion,
+            max_lines=LITE_MAX_LINES,
+            tokens_per_line=LITE_TOKENS_PER_LINE
+        )
+    if LLM_BATCHING:
+        llm_batcher = LLMBatcher(
+            expand_abbreviations,
+            window=LLM_BATCH_WINDOW,
+            max_messages=LLM_BATCH_MAX_MESSAGES,
+            token_budget=LLM_BATCH_TOKEN_BUDGET
+        )
+        llm_batcher.start()
+    
+    # Конвейер: расшифровка -> разбор -> запись в таблицу -> архивация
+    handlers = {"expand": stage_expand, "parse": stage_parse, "write": stage_write, "archive": stage_archive}
+    pipeline = Pipeline([
+        Stage(name, handlers[name], **settings) for name, settings in PIPELINE_STAGES.items()
+    ])
+    pipeline.start()
+    
+    if METRICS_PORT is not None:
+        register_gauges()
+        metrics_runner = await timed("метрики", start_metrics_server(METRICS_HOST, METRICS_PORT))
+    
+    startup_timings["всего"] = time.perf_counter() - started
+    logger.info("Время запуска: " + ", ".join(
+        f"{name} {seconds:.2f} с" for name, seconds in startup_timings.items()
+    ))
+    
+    if not token_ready:
         logger.error("Не удалось получить начальный IAM-токен")
+        return False
+    return True
+
+async def shutdown():
+    """Дообрабатывает принятые сообщения, дописывает очереди и закрывает подключения"""
+    if report_store_task is not None:
+        report_store_task.cancel()
+    # Принятые фото дораспознаются и попадают в конвейер до его остановки
+    if photo_tasks:
+        await asyncio.gather(*photo_tasks, return_exceptions=True)
+    if photo_processor is not None:
+        await photo_processor.stop()
+    if pipeline is not None:
+        await pipeline.stop()
+    if llm_batcher is not None:
+        await llm_batcher.stop()
+    await iam_tokens.stop()
+    if outbox is not None:
+        await outbox.stop()
+    if sheet_sink is not None:
+        await sheet_sink.stop()
+    if drive_archiver is not None:
+        await drive_archiver.stop()
+    if llm_cache is not None:
+        await llm_cache.close()
+    if counter_store is not None:
+        await counter_store.close()
+    if api_client is not None:
+        await api_client.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+def webhook_worker(index: int, updates, workers: int, overrides: dict = None):
+    """Точка входа процесса-обработчика; overrides - значения глобальных настроек модуля"""
+    if overrides:
+        globals().update(overrides)
+    asyncio.run(run_webhook_worker(index, updates, workers))
+
+async def run_webhook_worker(index: int, updates, workers: int):
+    """Берет обновления своих чатов из очереди и ставит их в конвейер по порядку"""
+    global METRICS_PORT
+    # Квоты внешних API делятся между процессами поровну
+    for name in ("yandexgpt", "iam", "drive", "vision"):
+        limiters[name] = AdaptiveRateLimiter(name, **split_quota(RATE_LIMITS[name], workers))
+    if METRICS_PORT is not None:
+        METRICS_PORT += 1 + index
+    
+    if not await startup(worker=True):
+        await shutdown()
         return
+    
     bot = Bot(token=TELEGRAM_TOKEN)
     dp = Dispatcher()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            try:
+                await dp.feed_raw_update(bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {str(e)}")
+    finally:
+        await shutdown()
+        await bot.session.close()
+
+def is_loopback(host: str) -> bool:
+    """Адрес доступен только с этой машины"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+async def run_webhook(overrides: dict = None, stop: asyncio.Event = None):
+    """Режим вебхука: прием обновлений и запись в таблицу в этом процессе,
+    обработка сообщений - в WEBHOOK_WORKERS процессах; работает до отмены или stop"""
+    global sheet_sink, outbox, metrics_runner, report_store_task
+    secret = WEBHOOK_SECRET or (secrets.token_urlsafe(32) if WEBHOOK_URL else None)
+    if secret is None and not is_loopback(WEBHOOK_HOST):
+        # Без секрета запись в таблицу мог бы вызвать любой, кто достучится до порта
+        logger.error(f"Вебхук на {WEBHOOK_HOST} без WEBHOOK_SECRET принимал бы любые запросы: "
+                     f"задайте WEBHOOK_SECRET или WEBHOOK_HOST = '127.0.0.1'")
+        return
+    sheet_sink = SheetSink(google.worksheet, limiter=limiters["sheets"], on_written=on_rows_written)
+    outbox = Outbox(DATABASE_FILE, deliver_new_rows, batch_size=OUTBOX_BATCH_ROWS)
+    await outbox.start()
+    sheet_sink.start()
+    report_store_task = asyncio.create_task(load_report_store())
     
-    # Запускаем фоновую задачу для обновления токена
-    asyncio.create_task(refresh_iam_token(3600))
+    pool = WorkerPool(multiprocessing.get_context("spawn"), webhook_worker, WEBHOOK_WORKERS,
+                      queue_size=WEBHOOK_QUEUE_SIZE, args=(overrides,))
+    pool.start()
+    if METRICS_PORT is not None:
+        register_gauges()
+        REGISTRY.gauge("agro_webhook_queue", "Обновления в очереди процесса-обработчика", ("worker",),
+                       lambda: {(str(index),): depth for index, depth in pool.depths().items()})
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
+    runner = await start_webhook_server(pool, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, secret,
+                                        intercept=answer_webhook_command)
+    bot = None
+    try:
+        if WEBHOOK_URL:
+            bot = Bot(token=TELEGRAM_TOKEN)
+            await bot.set_webhook(WEBHOOK_URL, secret_token=secret)
+        await (stop or asyncio.Event()).wait()
+    finally:
+        await runner.cleanup()
+        await pool.stop()
+        await shutdown()
+        if bot is not None:
+            await bot.session.close()
+
+async def main():
+    if WEBHOOK_MODE:
+        await run_webhook()
+        return
+    
+    # Инициализируем токен и подсистемы при старте
+    if not await startup():
+        await shutdown()
+        return
+    
+    bot = Bot(token=TELEGRAM_TOKEN)
+    dp = Dispatcher()
+    dp.include_router(router)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
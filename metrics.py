@@ -0,0 +1,202 @@
+import contextvars
+import logging
+import threading
+import uuid
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Идентификатор трассировки текущего сообщения, попадает в каждую строку лога
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+class TraceIdFilter(logging.Filter):
+    """Добавляет в записи лога поле trace_id из контекста"""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Значение, вычисляемое при каждом запросе метрик функцией collect().
+
+    collect возвращает число или словарь {кортеж значений меток: число}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def render(self) -> list:
+        if self.collect is None:
+            return []
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрики {self.name}: {str(e)}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            labels = _format_labels(self.labelnames, key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                bucket_labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+            inf_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        # Повторная регистрация (например, при перезапуске подсистем) заменяет метрику
+        self._metrics = [existing for existing in self._metrics if existing.name != metric.name]
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+    "agro_llm_request_seconds", "Время запроса к YandexGPT", ("model", "result"))
+LLM_ROUTING = REGISTRY.counter(
+    "agro_llm_routing_total", "Ответы моделей YandexGPT: принятые, отправленные в полную модель, ошибки",
+    ("tier", "outcome"))
+LLM_TOKENS = REGISTRY.counter(
+    "agro_llm_tokens_total", "Токены YandexGPT по полю usage", ("direction",))
+FIRST_ROW_SECONDS = REGISTRY.histogram(
+    "agro_first_row_seconds", "Время от начала расшифровки до первой готовой строки в потоковом режиме")
+PARSE_SECONDS = REGISTRY.histogram(
+    "agro_parse_seconds", "Время разбора ответа модели на строки отчета")
+SHEET_BATCH_SECONDS = REGISTRY.histogram(
+    "agro_sheet_batch_seconds", "Время записи одной пачки строк в Google Sheets", ("result",))
+SHEET_ROW_SECONDS = REGISTRY.histogram(
+    "agro_sheet_row_seconds", "Время записи пачки в пересчете на одну строку")
+SHEET_ROWS = REGISTRY.counter(
+    "agro_sheet_rows_total", "Строки, отправленные в Google Sheets", ("result",))
+DRIVE_UPLOAD_SECONDS = REGISTRY.histogram(
+    "agro_drive_upload_seconds", "Время загрузки файла в Google Drive", ("result",))
+PHOTO_PREPROCESS_SECONDS = REGISTRY.histogram(
+    "agro_photo_preprocess_seconds", "Время подготовки фото отчета к распознаванию")
+OCR_REQUEST_SECONDS = REGISTRY.histogram(
+    "agro_ocr_request_seconds", "Время запроса к Yandex Vision OCR", ("result",))
+REPORT_LINES = REGISTRY.counter(
+    "agro_report_lines_total", "Строки отчетов по результату обработки", ("result",))
+IAM_REFRESH = REGISTRY.counter(
+    "agro_iam_refresh_total", "Получение IAM-токена", ("result",))
+
+
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY):
+    """Запускает HTTP-эндпоинт /metrics в формате Prometheus"""
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,100 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from http_client import LLMResult
+from llm_batcher import BATCH_HEADER
+from metrics import LLM_ROUTING
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TierStats:
+    requests: int = 0
+    seconds: float = 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.seconds / self.requests if self.requests else 0.0
+
+
+@dataclass
+class RoutingStats:
+    lite: TierStats = field(default_factory=TierStats)
+    full: TierStats = field(default_factory=TierStats)
+    escalations: int = 0
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.escalations / self.lite.requests if self.lite.requests else 0.0
+
+
+class ModelRouter:
+    """Выбор модели для расшифровки: короткие сообщения - в YandexGPT Lite, остальные - в полную.
+
+    Lite получает сообщения не длиннее max_lines строк с maxTokens по числу строк.
+    Если ее ответ не проходит validate(text) (причина или None), сообщение
+    отправляется в полную модель. Ошибка запроса к Lite (сеть, квота) возвращается
+    как есть: полная модель ее не исправит. complete(text, model_uri, max_tokens) -
+    один запрос к модели.
+    """
+
+    def __init__(self, complete, lite_model: str, full_model: str, validate,
+                 max_lines: int = 4, tokens_per_line: int = 60, min_tokens: int = 100):
+        self.complete = complete
+        self.lite_model = lite_model
+        self.full_model = full_model
+        self.validate = validate
+        self.max_lines = max_lines
+        self.tokens_per_line = tokens_per_line
+        self.min_tokens = min_tokens
+        self.stats = RoutingStats()
+
+    def lite_max_tokens(self, text: str) -> Optional[int]:
+        """maxTokens для Lite; None - сообщение для Lite слишком длинное или это пакет сообщений"""
+        if text.startswith(BATCH_HEADER):
+            return None
+        lines = sum(1 for line in text.split('\n') if line.strip())
+        if lines > self.max_lines:
+            return None
+        return max(self.min_tokens, lines * self.tokens_per_line)
+
+    async def _timed(self, tier: str, text: str, model_uri: str, max_tokens: int) -> LLMResult:
+        started = time.perf_counter()
+        result = await self.complete(text, model_uri, max_tokens)
+        stats = getattr(self.stats, tier)
+        stats.requests += 1
+        stats.seconds += time.perf_counter() - started
+        return result
+
+    async def expand(self, text: str, max_tokens: int = 2000) -> LLMResult:
+        lite_tokens = self.lite_max_tokens(text)
+        if lite_tokens is not None:
+            result = await self._timed("lite", text, self.lite_model, lite_tokens)
+            if not result.ok:
+                LLM_ROUTING.inc(tier="lite", outcome="error")
+                self._log()
+                return result
+            reason = self.validate(result.text)
+            if reason is None:
+                LLM_ROUTING.inc(tier="lite", outcome="accepted")
+                self._log()
+                return result
+            self.stats.escalations += 1
+            LLM_ROUTING.inc(tier="lite", outcome="escalated")
+            logger.info(f"Ответ YandexGPT Lite не прошел проверку ({reason}), запрос к полной модели")
+
+        result = await self._timed("full", text, self.full_model, max_tokens)
+        LLM_ROUTING.inc(tier="full", outcome="accepted" if result.ok else "error")
+        self._log()
+        return result
+
+    def _log(self):
+        stats = self.stats
+        logger.info(
+            f"Модели: Lite {stats.lite.requests} запросов, в среднем {stats.lite.mean_seconds:.2f} с, "
+            f"эскалаций {stats.escalation_rate:.0%}; полная {stats.full.requests} запросов, "
+            f"в среднем {stats.full.mean_seconds:.2f} с"
+        )
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Optional
+
+import aiosqlite
+
+from metrics import SHEET_ROWS
+from sheet_sink import RowsRejected
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Локальная очередь строк отчетов перед записью в Google Sheets.
+
+    Строки сначала фиксируются в SQLite (WAL) с ключом идемпотентности
+    "чат:сообщение:строка", затем фоновая задача передает их в deliver пачками
+    и отмечает доставленными (без deliver строки только фиксируются, а доставляет
+    их другой процесс с той же базой). После перезапуска недоставленные строки
+    отправляются снова, а повтор того же ключа не создает вторую строку.
+    Вместе со строками сохраняется итог обработки сообщения, чтобы повторно
+    присланное сообщение не отправлялось в YandexGPT еще раз.
+
+    Сбои записи (сеть, ошибки Google, исчерпанная квота) повторяются без
+    ограничения числа попыток, пауза растет до max_retry_interval. Если deliver
+    поднимает RowsRejected (таблица отвергла строки как некорректный запрос),
+    пачка уменьшается вдвое; строка, отвергнутая max_attempts раз подряд
+    (последний раз - одна), откладывается (delivered = -1) и больше не
+    задерживает очередь. Успешная запись обнуляет счетчики отказов.
+
+    Доставляет очередь только один процесс с той же базой: он держит аренду
+    (outbox_drainer) и продлевает ее каждые lease_interval / 3 секунд. Остальные
+    процессы с deliver ждут, пока аренда не освободится (draining = False).
+    """
+
+    def __init__(self, db_path: str, deliver, batch_size: int = 200,
+                 poll_interval: float = 1.0, retry_interval: float = 5.0,
+                 max_retry_interval: float = 300.0, max_attempts: int = 5,
+                 retention: float = 7 * 24 * 3600, lease_interval: float = 30.0):
+        self.db_path = db_path
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.lease_interval = lease_interval
+        self.owner = uuid.uuid4().hex
+        self.draining = False
+        self.pending = 0
+        self.parked = 0
+        self._db = None
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        self._lease_task = None
+
+    async def start(self):
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sheet_outbox ("
+            "row_key TEXT PRIMARY KEY, message_key TEXT NOT NULL, row TEXT NOT NULL, "
+            "delivered INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL)"
+        )
+        async with self._db.execute("PRAGMA table_info(sheet_outbox)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if "attempts" not in columns:
+            # База, созданная до учета неудачных попыток
+            await self._db.execute("ALTER TABLE sheet_outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        await self._db.execute(
+            "CREATE INDEX IF NOT EXISTS sheet_outbox_pending ON sheet_outbox (delivered)"
+        )
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS processed_messages ("
+            "message_key TEXT PRIMARY KEY, summary TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_drainer ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), owner TEXT NOT NULL, lease_until REAL NOT NULL)"
+        )
+        # Старые доставленные строки и итоги сообщений больше не нужны для проверки повторов
+        expired = time.time() - self.retention
+        await self._db.execute("DELETE FROM sheet_outbox WHERE delivered = 1 AND created < ?", (expired,))
+        await self._db.execute("DELETE FROM processed_messages WHERE created < ?", (expired,))
+        await self._db.commit()
+
+        async with self._db.execute("SELECT COUNT(*) FROM sheet_outbox WHERE delivered = 0") as cursor:
+            (self.pending,) = await cursor.fetchone()
+        if self.deliver is None:
+            return
+        async with self._db.execute("SELECT COUNT(*) FROM sheet_outbox WHERE delivered = -1") as cursor:
+            (parked,) = await cursor.fetchone()
+        if parked:
+            logger.warning(
+                f"В очереди записи {parked} отложенных строк, которые не удалось записать в таблицу "
+                f"(вернуть в очередь: delivered = 0 в {self.db_path})"
+            )
+        if self.pending:
+            logger.info(f"В очереди записи в таблицу после перезапуска: {self.pending} строк")
+        await self._renew_lease()
+        if not self.draining:
+            logger.warning("Очередь записи в таблицу доставляет другой процесс с той же базой, ждем освобождения")
+        self._lease_task = asyncio.create_task(self._lease_loop())
+        self._task = asyncio.create_task(self._drain_loop())
+
+    async def stop(self, timeout: float = 30):
+        """Дожидается доставки очереди (не дольше timeout) и закрывает базу"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Запись в таблицу не завершена, в очереди осталось {self.pending} строк")
+            self._task = None
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+            try:
+                await self._lease_task
+            except asyncio.CancelledError:
+                pass
+            self._lease_task = None
+            # Другой процесс может сразу продолжить доставку
+            try:
+                async with self._lock:
+                    await self._db.execute("DELETE FROM outbox_drainer WHERE owner = ?", (self.owner,))
+                    await self._db.commit()
+            except Exception as e:
+                logger.error(f"Ошибка освобождения очереди записи: {str(e)}")
+            self.draining = False
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def processed(self, message_key: str) -> Optional[dict]:
+        """Итог обработки сообщения, если оно уже было зафиксировано"""
+        async with self._db.execute(
+            "SELECT summary FROM processed_messages WHERE message_key = ?", (message_key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def commit(self, message_key: str, rows: list, summary: Optional[dict] = None):
+        """Фиксирует строки [(ключ строки, данные)] и итог сообщения одной транзакцией.
+
+        Без summary фиксируются только строки: сообщение еще обрабатывается.
+        """
+        async with self._lock:
+            cursor = await self._db.executemany(
+                "INSERT OR IGNORE INTO sheet_outbox (row_key, message_key, row, created) VALUES (?, ?, ?, ?)",
+                [(row_key, message_key, json.dumps(row, ensure_ascii=False), time.time()) for row_key, row in rows]
+            )
+            added = max(0, cursor.rowcount)
+            if summary is not None:
+                await self._db.execute(
+                    "INSERT OR REPLACE INTO processed_messages (message_key, summary, created) VALUES (?, ?, ?)",
+                    (message_key, json.dumps(summary, ensure_ascii=False), time.time())
+                )
+            await self._db.commit()
+        self.pending += added
+        self._wakeup.set()
+
+    async def _fetch(self, limit: int) -> list:
+        async with self._db.execute(
+            "SELECT row_key, row, attempts FROM sheet_outbox WHERE delivered = 0 ORDER BY rowid LIMIT ?",
+            (limit,)
+        ) as cursor:
+            return [(row_key, json.loads(row), attempts) for row_key, row, attempts in await cursor.fetchall()]
+
+    async def _mark_delivered(self, keys: list, reset_attempts: bool = False):
+        async with self._lock:
+            await self._db.executemany(
+                "UPDATE sheet_outbox SET delivered = 1, attempts = 0 WHERE row_key = ?", [(key,) for key in keys]
+            )
+            if reset_attempts:
+                await self._db.execute("UPDATE sheet_outbox SET attempts = 0 WHERE delivered = 0 AND attempts > 0")
+            await self._db.commit()
+        self.pending -= len(keys)
+
+    async def _record_rejection(self, batch: list):
+        """Учитывает отказ таблицы принять пачку и откладывает строки, исчерпавшие попытки"""
+        # Откладывается только строка, отвергнутая одна: в пачке виновата может быть соседняя
+        parked = [(row_key, row, attempts + 1) for row_key, row, attempts in batch
+                  if len(batch) == 1 and attempts + 1 >= self.max_attempts]
+        async with self._lock:
+            await self._db.executemany(
+                "UPDATE sheet_outbox SET attempts = attempts + 1 WHERE row_key = ?",
+                [(row_key,) for row_key, _, _ in batch]
+            )
+            await self._db.executemany(
+                "UPDATE sheet_outbox SET delivered = -1 WHERE row_key = ?", [(row_key,) for row_key, _, _ in parked]
+            )
+            await self._db.commit()
+        for row_key, row, attempts in parked:
+            logger.error(
+                f"Таблица {attempts} раз отвергла строку {row_key}, строка отложена: {'; '.join(row)}"
+            )
+        if parked:
+            SHEET_ROWS.inc(len(parked), result="parked")
+            self.pending -= len(parked)
+            self.parked += len(parked)
+
+    async def _renew_lease(self):
+        """Берет или продлевает аренду доставки; draining - удалось ли"""
+        now = time.time()
+        async with self._lock:
+            cursor = await self._db.execute(
+                "INSERT INTO outbox_drainer (id, owner, lease_until) VALUES (1, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until "
+                "WHERE outbox_drainer.owner = excluded.owner OR outbox_drainer.lease_until <= ?",
+                (self.owner, now + self.lease_interval, now)
+            )
+            await self._db.commit()
+        draining = cursor.rowcount == 1
+        if draining and not self.draining:
+            self._wakeup.set()
+        elif self.draining and not draining:
+            logger.warning("Аренда доставки очереди записи перешла к другому процессу")
+        self.draining = draining
+
+    async def _lease_loop(self):
+        while True:
+            await asyncio.sleep(self.lease_interval / 3)
+            try:
+                await self._renew_lease()
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды очереди записи: {str(e)}")
+
+    async def _drain_loop(self):
+        limit = self.batch_size
+        failures = 0
+        while True:
+            self._wakeup.clear()
+            if not self.draining:
+                # Очередь доставляет другой процесс
+                if self._stopping:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.lease_interval / 3)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                batch = await self._fetch(limit)
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди записи в таблицу: {str(e)}")
+                batch = []
+            if len(batch) < limit:
+                # Строки могут добавлять и другие процессы: неполная пачка - это вся очередь
+                self.pending = len(batch)
+            if not batch:
+                if self._stopping:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            rejected = False
+            try:
+                written = await self.deliver([row for _, row, _ in batch])
+            except RowsRejected as e:
+                logger.warning(f"Таблица отвергла пачку из {len(batch)} строк: {str(e)}")
+                written, rejected = 0, True
+            except Exception as e:
+                logger.error(f"Ошибка записи в таблицу: {str(e)}")
+                written = 0
+            if written == len(batch):
+                await self._mark_delivered([key for key, _, _ in batch], reset_attempts=failures > 0)
+                limit = min(self.batch_size, limit * 2)
+                failures = 0
+                continue
+
+            failures += 1
+            if rejected:
+                # Пачка уменьшается, чтобы строка, которую таблица не принимает, осталась одна
+                limit = max(1, limit // 2)
+                delay = self.retry_interval
+                try:
+                    await self._record_rejection(batch)
+                except Exception as e:
+                    logger.error(f"Ошибка учета отказов записи в таблицу: {str(e)}")
+            else:
+                # Сбой сети или Google: строки не откладываются, повторяем, пока запись не пройдет
+                delay = min(self.max_retry_interval, self.retry_interval * 2 ** min(failures - 1, 16))
+            logger.warning(f"Не удалось записать в таблицу {len(batch)} строк, повтор через {delay:g} с")
+            if self._stopping:
+                return
+            await asyncio.sleep(delay)
@@ -0,0 +1,141 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from metrics import PHOTO_PREPROCESS_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OcrResult:
+    """Текст, распознанный на фото, или описание ошибки"""
+    text: str = ""
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def otsu_threshold(histogram: list) -> int:
+    """Порог бинаризации по методу Оцу для гистограммы изображения в оттенках серого"""
+    total = sum(histogram)
+    weighted_total = sum(value * count for value, count in enumerate(histogram))
+    background = weighted_background = 0
+    best_threshold, best_variance = 127, -1.0
+    for value, count in enumerate(histogram):
+        background += count
+        if not background:
+            continue
+        foreground = total - background
+        if not foreground:
+            break
+        weighted_background += value * count
+        mean_background = weighted_background / background
+        mean_foreground = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = value, variance
+    return best_threshold
+
+
+def preprocess_image(data: bytes, max_side: int = 2000) -> bytes:
+    """Уменьшает фото до max_side по большей стороне и переводит в черно-белое (PNG).
+
+    Выполняется в отдельном процессе, поэтому принимает и возвращает байты.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert("L")
+    image.thumbnail((max_side, max_side))
+    image = ImageOps.autocontrast(image, cutoff=1)
+    threshold = otsu_threshold(image.histogram())
+    image = image.point(lambda value: 255 if value > threshold else 0, mode="1")
+    output = io.BytesIO()
+    image.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+class PhotoProcessor:
+    """Распознавание фото отчетов: загрузка, подготовка изображения и OCR.
+
+    Подготовка изображений идет в пуле из workers процессов, чтобы не занимать
+    цикл событий. Одновременно обрабатывается не больше concurrency фото, а
+    загруженные, но еще не подготовленные изображения занимают в памяти не
+    больше memory_limit байт: следующее фото загружается, когда место освободится.
+    recognize(image) отправляет подготовленное изображение в OCR и возвращает OcrResult.
+    """
+
+    def __init__(self, recognize, workers: int = 2, concurrency: int = 4,
+                 memory_limit: int = 64 * 1024 * 1024, max_side: int = 2000):
+        self.recognize = recognize
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.max_side = max_side
+        self.buffered = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._memory = asyncio.Condition()
+        self._executor = None
+
+    def start(self):
+        """Запускает пул; вызывается до запуска потоков бота, чтобы процессы можно было создать через fork"""
+        if multiprocessing.current_process().daemon:
+            # Процесс-обработчик вебхука запущен демоном и не может порождать процессы;
+            # изображения готовятся в потоках (Pillow отпускает GIL на тяжелых операциях)
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="photo")
+            return
+        # При spawn каждый процесс заново импортирует главный модуль бота, это секунды;
+        # fork запускает процессы сразу
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+        # Процессы создаются сейчас, а не с первым фото
+        self._executor.submit(otsu_threshold, [0])
+
+    async def stop(self):
+        if self._executor is not None:
+            await asyncio.to_thread(self._executor.shutdown)
+            self._executor = None
+
+    async def _reserve(self, size: int):
+        async with self._memory:
+            # Фото больше лимита ждет, пока не освободится вся память, и обрабатывается одно
+            await self._memory.wait_for(lambda: self.buffered == 0 or self.buffered + size <= self.memory_limit)
+            self.buffered += size
+
+    async def _release(self, size: int):
+        async with self._memory:
+            self.buffered -= size
+            self._memory.notify_all()
+
+    async def process(self, size: int, download) -> OcrResult:
+        """size - размер файла по данным Telegram (0 - неизвестен), download() - загрузка байтов фото"""
+        size = size or self.memory_limit
+        async with self._slots:
+            await self._reserve(size)
+            try:
+                try:
+                    data = await download()
+                except Exception as e:
+                    logger.error(f"Ошибка загрузки фото: {str(e)}")
+                    return OcrResult(error="Не удалось загрузить фото")
+                started = time.perf_counter()
+                try:
+                    image = await asyncio.get_running_loop().run_in_executor(
+                        self._executor, preprocess_image, data, self.max_side
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка подготовки фото: {str(e)}")
+                    return OcrResult(error="Не удалось прочитать изображение")
+                finally:
+                    del data
+                PHOTO_PREPROCESS_SECONDS.observe(time.perf_counter() - started)
+            finally:
+                await self._release(size)
+            return await self.recognize(image)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from metrics import trace_id_var
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """Этап обработки: своя ограниченная очередь и пул из concurrency обработчиков.
+
+    handler(job) возвращает задание для следующего этапа или None, если
+    обработку задания нужно завершить на этом этапе.
+    """
+
+    def __init__(self, name: str, handler, concurrency: int = 1, queue_size: int = 100):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = 0
+
+
+class Pipeline:
+    """Цепочка этапов, связанных ограниченными очередями.
+
+    Если очередь следующего этапа заполнена, обработчики текущего этапа ждут,
+    и давление доходит до submit: новые сообщения не принимаются быстрее,
+    чем система успевает их обработать.
+    """
+
+    def __init__(self, stages: list):
+        self.stages = stages
+        self._workers = []
+        self._accepting = False
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for _ in range(stage.concurrency):
+                self._workers.append(asyncio.create_task(self._worker(stage, next_stage)))
+        self._accepting = True
+
+    async def submit(self, job):
+        """Ставит задание в первый этап; ждет, если очередь заполнена"""
+        if not self._accepting:
+            raise RuntimeError("Конвейер обработки остановлен")
+        await self.stages[0].queue.put(job)
+
+    async def stop(self):
+        """Перестает принимать задания, дообрабатывает очереди по порядку этапов и останавливает обработчики"""
+        self._accepting = False
+        for stage in self.stages:
+            await stage.queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def depths(self) -> dict:
+        """Размеры очередей и число заданий в обработке по этапам"""
+        return {
+            stage.name: {"queued": stage.queue.qsize(), "in_flight": stage.in_flight}
+            for stage in self.stages
+        }
+
+    async def _worker(self, stage: Stage, next_stage):
+        while True:
+            job = await stage.queue.get()
+            stage.in_flight += 1
+            # Строки лога этапа помечаются идентификатором трассировки задания
+            token = trace_id_var.set(getattr(job, "trace_id", "-"))
+            try:
+                result = await stage.handler(job)
+                if result is not None and next_stage is not None:
+                    await next_stage.queue.put(result)
+            except Exception as e:
+                logger.error(f"Ошибка на этапе {stage.name}: {str(e)}")
+            finally:
+                trace_id_var.reset(token)
+                stage.in_flight -= 1
+                stage.queue.task_done()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: rate единиц в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Сколько ждать, пока в ведре наберется amount; 0 - если можно сразу"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def take(self, amount: float):
+        self._tokens -= min(amount, self.capacity)
+
+
+class AdaptiveRateLimiter:
+    """Ограничитель запросов к одному внешнему API.
+
+    Запросы проходят через два ведра токенов (запросы в секунду и, при
+    необходимости, токены модели в минуту) и лимит одновременных запросов.
+    Лимит параллельности подстраивается: при ответе 429 уменьшается вдвое,
+    при быстрых успешных ответах растет на единицу. Ожидающие запросы стоят
+    в очереди, а не завершаются ошибкой.
+    """
+
+    def __init__(self, name: str, requests_per_second: float,
+                 tokens_per_minute: Optional[float] = None,
+                 max_concurrency: int = 8, min_concurrency: int = 1,
+                 target_latency: float = 5.0):
+        self.name = name
+        self.requests = TokenBucket(requests_per_second, max(1.0, requests_per_second))
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self.concurrency = float(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.throttled = 0
+        self._condition = asyncio.Condition()
+        self._lock = asyncio.Lock()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_concurrency, int(self.concurrency))
+
+    async def acquire(self, tokens: float = 0):
+        self.waiting += 1
+        try:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.active < self.limit)
+                self.active += 1
+            # Ведра проверяются по очереди, чтобы запросы выходили в порядке поступления
+            async with self._lock:
+                while True:
+                    delay = self.requests.delay(1)
+                    if self.tokens is not None and tokens:
+                        delay = max(delay, self.tokens.delay(tokens))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                if self.tokens is not None and tokens:
+                    self.tokens.take(tokens)
+        except BaseException:
+            await self._release()
+            raise
+        finally:
+            self.waiting -= 1
+
+    async def _release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    async def release(self, latency: float, throttled: bool = False):
+        """Освобождает слот и подстраивает параллельность по результату запроса"""
+        if throttled:
+            self.throttled += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            logger.warning(f"{self.name}: превышена квота, параллельность снижена до {self.limit}")
+        elif latency > self.target_latency:
+            self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / max(1.0, self.concurrency))
+        await self._release()
+
+    @asynccontextmanager
+    async def slot(self, tokens: float = 0):
+        """Контекст одного запроса; при ответе о превышении квоты выставьте state["throttled"] = True"""
+        await self.acquire(tokens)
+        state = {"throttled": False}
+        started = time.monotonic()
+        try:
+            yield state
+        finally:
+            await self.release(time.monotonic() - started, state["throttled"])
+
+
+def _error_status(error: Exception):
+    """HTTP-статус ответа Google API (gspread APIError или googleapiclient HttpError) или None"""
+    response = getattr(error, "response", None)
+    if response is None:
+        response = getattr(error, "resp", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        status = getattr(response, "status", None)
+    return int(status) if status is not None else None
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Ответ Google API о превышении квоты (gspread APIError или googleapiclient HttpError)"""
+    if _error_status(error) == 429:
+        return True
+    text = str(error).lower()
+    return "quota" in text or "ratelimitexceeded" in text or "rate limit" in text
+
+
+def is_rejected_request(error: Exception) -> bool:
+    """Google API отверг сам запрос (4xx): повтор тех же данных не поможет.
+
+    Ошибки доступа, отсутствующая таблица и тайм-аут сюда не относятся -
+    они исправляются настройкой или проходят сами.
+    """
+    status = _error_status(error)
+    return (status is not None and 400 <= status < 500 and status not in (401, 403, 404, 408, 429)
+            and not is_quota_error(error))
@@ -0,0 +1,200 @@
+import logging
+import re
+from datetime import date, datetime
+from typing import Optional
+
+import numpy as np
+
+from google_services import SHEET_HEADER
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%d/%m/%Y"
+THOUSANDS_RE = re.compile(r"^\d,\d{3}$")
+
+
+def parse_hectares(value: str) -> float:
+    """Гектары из ячейки: "1,816" - четырехзначное значение, "12,5" - дробное"""
+    value = str(value).strip().replace(" ", "")
+    if THOUSANDS_RE.match(value):
+        return float(value.replace(",", ""))
+    try:
+        return float(value.replace(",", "."))
+    except ValueError:
+        return np.nan
+
+
+def parse_day(value: str) -> int:
+    """Дата DD/MM/YYYY в номер дня; -1, если дата не распознана"""
+    try:
+        return datetime.strptime(str(value).strip(), DATE_FORMAT).toordinal()
+    except ValueError:
+        return -1
+
+
+class Dictionary:
+    """Словарное кодирование строкового столбца: значение - номер в списке values"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def code(self, value: str) -> Optional[int]:
+        return self.codes.get(value)
+
+
+class ReportStore:
+    """Локальная копия строк таблицы в столбцах NumPy.
+
+    Участок, операция и культура хранятся кодами словарей, дата - номером дня.
+    Индекс (участок, операция, культура) дает строки одной операции, по нему
+    проверяется "С начала операции"; сводки считаются векторно по маске дат. Копия восстанавливается из таблицы одним
+    чтением get_all_values и дальше пополняется записанными строками.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.areas = Dictionary()
+        self.operations = Dictionary()
+        self.cultures = Dictionary()
+        self.size = 0
+        self.loaded = False
+        self._allocate(capacity)
+        self._index = {}
+
+    def _allocate(self, capacity: int):
+        self._date = np.empty(capacity, dtype=np.int32)
+        self._area = np.empty(capacity, dtype=np.int32)
+        self._operation = np.empty(capacity, dtype=np.int32)
+        self._culture = np.empty(capacity, dtype=np.int32)
+        self._day_ha = np.empty(capacity, dtype=np.float64)
+        self._total_ha = np.empty(capacity, dtype=np.float64)
+
+    def _grow(self, needed: int):
+        capacity = len(self._date)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("_date", "_area", "_operation", "_culture", "_day_ha", "_total_ha"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _encode(self, row: list) -> tuple:
+        """(день, участок, операция, культура) строки таблицы; None - если строка неполная"""
+        if len(row) < 6:
+            return None
+        return (
+            parse_day(row[0]),
+            self.areas.encode(row[1].strip()),
+            self.operations.encode(row[2].strip()),
+            self.cultures.encode(row[3].strip()),
+        )
+
+    def add_rows(self, rows: list):
+        """Добавляет строки [дата, участок, операция, культура, за день, всего]"""
+        self._grow(self.size + len(rows))
+        for row in rows:
+            key = self._encode(row)
+            if key is None:
+                continue
+            position = self.size
+            self._date[position], self._area[position], self._operation[position], self._culture[position] = key
+            self._day_ha[position] = parse_hectares(row[4])
+            self._total_ha[position] = parse_hectares(row[5])
+            self._index.setdefault(key[1:], []).append(position)
+            self.size += 1
+
+    def rebuild(self, values: list):
+        """Заменяет копию строками листа (результат get_all_values)"""
+        if values and [cell.strip() for cell in values[0][:len(SHEET_HEADER)]] == SHEET_HEADER:
+            values = values[1:]
+        self.areas, self.operations, self.cultures = Dictionary(), Dictionary(), Dictionary()
+        self.size = 0
+        self._allocate(max(1024, len(values)))
+        self._index = {}
+        self.add_rows(values)
+        self.loaded = True
+        logger.info(f"Локальная копия таблицы восстановлена: {self.size} строк")
+
+    def previous_total(self, day: str, area: str, operation: str, culture: str) -> Optional[float]:
+        """Значение "С начала операции" за последний день раньше day (DD/MM/YYYY) по той же операции;
+        без даты - последнее записанное значение"""
+        codes = (self.areas.code(area), self.operations.code(operation), self.cultures.code(culture))
+        positions = self._index.get(codes) if None not in codes else None
+        if not positions:
+            return None
+        positions = np.asarray(positions)
+        positions = positions[~np.isnan(self._total_ha[positions])]
+        ordinal = parse_day(day)
+        if ordinal >= 0:
+            positions = positions[self._date[positions] < ordinal]
+        if not len(positions):
+            return None
+        if ordinal < 0:
+            return float(self._total_ha[positions[-1]])
+        # За последний день может быть несколько строк (уточнения), берется наибольшая
+        dates = self._date[positions]
+        return float(self._total_ha[positions[dates == dates.max()]].max())
+
+    def check_totals(self, rows: list) -> list:
+        """Предупреждения о строках, где "С начала операции" меньше предыдущего значения"""
+        warnings = []
+        last_total = {}
+        for row in rows:
+            if len(row) < 6:
+                continue
+            series = (row[1].strip(), row[2].strip(), row[3].strip())
+            total = parse_hectares(row[5])
+            if np.isnan(total):
+                continue
+            previous = last_total.get(series)
+            if previous is None:
+                previous = self.previous_total(row[0], *series)
+            if previous is not None and total < previous:
+                warnings.append(
+                    f"{', '.join(series)}: с начала операции {total:g} га меньше предыдущего значения {previous:g} га"
+                )
+            last_total[series] = total
+        return warnings
+
+    def summary(self, day: date, operation: Optional[str] = None) -> list:
+        """Сводка за день по (участок, операция, культура): сумма за день и наибольшее "всего" """
+        mask = self._date[:self.size] == day.toordinal()
+        if operation is not None:
+            code = self.operations.code(operation)
+            if code is None:
+                return []
+            mask &= self._operation[:self.size] == code
+        positions = np.flatnonzero(mask)
+        if not len(positions):
+            return []
+
+        keys = np.stack([self._area[positions], self._operation[positions], self._culture[positions]], axis=1)
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        day_ha = np.bincount(inverse, weights=np.nan_to_num(self._day_ha[positions]), minlength=len(groups))
+        total_ha = np.full(len(groups), -np.inf)
+        np.maximum.at(total_ha, inverse, np.nan_to_num(self._total_ha[positions], nan=-np.inf))
+
+        return [
+            {
+                "area": self.areas.values[area],
+                "operation": self.operations.values[operation_code],
+                "culture": self.cultures.values[culture],
+                "day_ha": float(day_ha[index]),
+                "total_ha": float(total_ha[index]) if np.isfinite(total_ha[index]) else None,
+            }
+            for index, (area, operation_code, culture) in enumerate(groups)
+        ]
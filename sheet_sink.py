@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+from metrics import SHEET_BATCH_SECONDS, SHEET_ROW_SECONDS, SHEET_ROWS
+from rate_limiter import is_quota_error, is_rejected_request
+
+logger = logging.getLogger(__name__)
+
+
+class RowsRejected(Exception):
+    """Google Sheets отверг пачку строк как некорректный запрос"""
+
+
+@dataclass
+class _PendingWrite:
+    """Строки одного сообщения, ожидающие записи в таблицу"""
+    rows: list
+    future: asyncio.Future = field(repr=False)
+
+
+class SheetSink:
+    """Собирает строки из всех сообщений в очередь и пишет их в таблицу пачками.
+
+    Сброс происходит одним вызовом append_rows, когда набралось max_rows строк
+    или прошло max_delay секунд с момента первой строки в пачке. Сам вызов
+    Google Sheets выполняется в отдельном потоке, чтобы не блокировать цикл событий;
+    там же при первой записи открывается лист через get_worksheet.
+    При превышении квоты Sheets пачка остается в очереди и повторяется позже.
+    Если Sheets отверг строки как некорректный запрос, write_rows поднимает
+    RowsRejected; при остальных ошибках возвращает 0.
+    on_written(rows) вызывается после каждой успешной записи, пока слот
+    ограничителя еще занят.
+    """
+
+    def __init__(self, get_worksheet, max_rows: int = 50, max_delay: float = 1.0,
+                 limiter=None, max_quota_retries: int = 20, on_written=None):
+        self.get_worksheet = get_worksheet
+        self.on_written = on_written
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.limiter = limiter
+        self.max_quota_retries = max_quota_retries
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописывает всё, что осталось в очереди, и останавливает фоновую задачу"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        """Число сообщений, ожидающих записи"""
+        return self._queue.qsize()
+
+    async def write_rows(self, rows: list) -> int:
+        """Ставит строки сообщения в очередь и возвращает, сколько из них записано; RowsRejected -
+        строки отвергнуты"""
+        if not rows:
+            return 0
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingWrite(rows=rows, future=future))
+        return await future
+
+    async def read_all(self) -> list:
+        """Все значения листа одним запросом, в очереди того же ограничителя, что и запись"""
+        async with (self.limiter.slot() if self.limiter is not None else nullcontext({})) as state:
+            try:
+                return await asyncio.to_thread(lambda: self.get_worksheet().get_all_values())
+            except Exception as e:
+                state["throttled"] = is_quota_error(e)
+                raise
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            row_count = len(item.rows)
+            deadline = time.monotonic() + self.max_delay
+
+            # Добираем строки до лимита по размеру или по времени
+            while row_count < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                row_count += len(item.rows)
+
+            await self._flush(batch)
+
+    def _append(self, rows: list):
+        self.get_worksheet().append_rows(rows)
+
+    async def _flush(self, batch: list):
+        rows = [row for item in batch for row in item.rows]
+        written = False
+        rejected = None
+        for attempt in range(self.max_quota_retries + 1):
+            quota_exceeded = False
+            async with (self.limiter.slot() if self.limiter is not None else nullcontext({})) as state:
+                started = time.perf_counter()
+                try:
+                    await asyncio.to_thread(self._append, rows)
+                    written = True
+                except Exception as e:
+                    quota_exceeded = is_quota_error(e)
+                    state["throttled"] = quota_exceeded
+                    rejected = str(e) if is_rejected_request(e) else None
+                    logger.error(f"Ошибка пакетной записи в таблицу ({len(rows)} строк): {str(e)}")
+                elapsed = time.perf_counter() - started
+                SHEET_BATCH_SECONDS.observe(elapsed, result="ok" if written else "error")
+                if written:
+                    SHEET_ROW_SECONDS.observe(elapsed / len(rows))
+                    if self.on_written is not None:
+                        try:
+                            self.on_written(rows)
+                        except Exception as e:
+                            logger.error(f"Ошибка обработки записанных строк: {str(e)}")
+            if written or not quota_exceeded:
+                break
+            await asyncio.sleep(random.uniform(0, min(60, 2 ** attempt)))
+
+        SHEET_ROWS.inc(len(rows), result="ok" if written else "error")
+        for item in batch:
+            if item.future.done():
+                continue
+            if rejected is not None:
+                item.future.set_exception(RowsRejected(rejected))
+            else:
+                item.future.set_result(len(item.rows) if written else 0)
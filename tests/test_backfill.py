@@ -0,0 +1,166 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+import backfill
+import main
+from bench.stubs import StubGoogleServices, StubServer
+from outbox import Outbox
+
+ROOT = Path(__file__).resolve().parent.parent
+
+REPORTS = [
+    "Восход Посев кук-24/252га24%",
+    "Пахота зяби под мн тр По Пу 26/488",
+    "Боронование под кук сил 35/120",
+    "диск сах св По Пу 70/1004 Отд 17 70/302",
+]
+
+
+def _message(message_id: int, text, message_type: str = "message") -> dict:
+    return {"id": message_id, "type": message_type, "date": "2026-05-12T08:31:10",
+            "from": "Иван", "from_id": "user42", "text": text}
+
+
+def _write_export(path, data: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 64, 1 << 20])
+def test_export_reader_streams_all_chats(tmp_path, chunk_size):
+    """Полный экспорт аккаунта: сообщения всех чатов по порядку при любом размере частей"""
+    path = tmp_path / "result.json"
+    _write_export(path, {"chats": {"list": [
+        {"name": 'Ферма "messages": [', "type": "private_supergroup", "id": 1234,
+         "messages": [_message(1, "Восход 1/2"), _message(2, [{"type": "bold", "text": "Мир"}, " 3/4"])]},
+        {"name": "Бригадир", "type": "personal_chat", "id": 77, "messages": []},
+        {"name": "Группа", "type": "private_group", "id": 55, "messages": [_message(3, "Север 5/6")]},
+    ]}})
+
+    messages = [(chat_id, message["id"], backfill.message_text(message))
+                for chat_id, message in backfill.ExportReader(str(path), chunk_size=chunk_size)]
+
+    assert messages == [
+        (-1001234, 1, "Восход 1/2"),
+        (-1001234, 2, "Мир 3/4"),
+        (-55, 3, "Север 5/6"),
+    ]
+
+
+def test_export_reader_rejects_truncated_export(tmp_path):
+    path = tmp_path / "result.json"
+    path.write_text('{"type": "personal_chat", "id": 1, "messages": [{"id": 1, "text": "a"}, {"id"',
+                    encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(backfill.ExportReader(str(path), chunk_size=16))
+
+
+def test_checkpoint_advances_over_contiguous_prefix(tmp_path):
+    export = tmp_path / "result.json"
+    path = str(tmp_path / "result.json.checkpoint")
+    checkpoint = backfill.Checkpoint(path, str(export))
+    checkpoint.finish(1, "1:2")
+    checkpoint.skip(2)
+    assert checkpoint.done == 0
+    checkpoint.finish(0, "1:1", ok=False)
+    assert checkpoint.done == 3
+    checkpoint.save()
+
+    resumed = backfill.Checkpoint(path, str(export))
+    assert resumed.done == 3
+    # Сообщение с ошибкой обрабатывается снова, остальные до отметки - нет
+    assert resumed.should_process(0, "1:1")
+    assert not resumed.should_process(1, "1:2")
+    assert resumed.should_process(3, "1:4")
+    resumed.finish(0, "1:1")
+    assert resumed.failed == set()
+
+
+def test_checkpoint_of_other_export_is_ignored(tmp_path):
+    path = str(tmp_path / "checkpoint")
+    checkpoint = backfill.Checkpoint(path, str(tmp_path / "first.json"))
+    checkpoint.skip(0)
+    checkpoint.save()
+    assert backfill.Checkpoint(path, str(tmp_path / "second.json")).done == 0
+
+
+@pytest.fixture
+def run_with_stubs(tmp_path, monkeypatch):
+    """Запускает корутину рядом с заменителями YandexGPT и Google API в одном цикле событий"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(main, "DATABASE_FILE", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(main, "COUNTERS_FILE", str(tmp_path / "counters.txt"))
+    monkeypatch.setattr(main, "METRICS_PORT", None)
+
+    def run(scenario):
+        async def wrapper():
+            server = StubServer(llm_latency=0.01)
+            await server.start()
+            monkeypatch.setattr(main, "IAM_URL", f"{server.base_url}/iam/v1/tokens")
+            monkeypatch.setattr(main, "COMPLETION_URL", f"{server.base_url}/foundationModels/v1/completion")
+            monkeypatch.setattr(main, "google", StubGoogleServices(server.base_url))
+            try:
+                await scenario(server)
+            finally:
+                await server.stop()
+
+        asyncio.run(wrapper())
+
+    return run
+
+
+async def _run_backfill(export, *options) -> backfill.BackfillStats:
+    args = backfill.parse_args([str(export), "--concurrency", "4", *options])
+    return await backfill.backfill(args)
+
+
+def test_resume_does_not_write_rows_twice(tmp_path, run_with_stubs):
+    export = tmp_path / "result.json"
+    messages = [_message(index + 1, f"{text}\nОтчет {index}") for index, text in enumerate(REPORTS * 3)]
+    messages.insert(3, _message(100, "", message_type="service"))
+    _write_export(export, {"type": "private_supergroup", "id": 1234, "messages": messages})
+
+    async def scenario(server):
+        first = await _run_backfill(export)
+        rows = len(server.sheet_rows)
+        assert first.imported == 12 and first.failed == 0 and first.undelivered == 0
+        assert rows > 0
+
+        # Прерывание после пятого сообщения: отметка стоит раньше, чем реально обработано
+        checkpoint = tmp_path / "result.json.checkpoint"
+        state = json.loads(checkpoint.read_text(encoding="utf-8"))
+        state["done"] = 5
+        checkpoint.write_text(json.dumps(state), encoding="utf-8")
+        completions = server.calls["completion"] + server.calls["completion_lite"]
+
+        resumed = await _run_backfill(export)
+        assert resumed.imported == 0
+        assert resumed.already_imported == 8
+        assert len(server.sheet_rows) == rows
+        assert server.calls["completion"] + server.calls["completion_lite"] == completions
+
+    run_with_stubs(scenario)
+
+
+def test_backfill_refuses_when_queue_is_drained_elsewhere(tmp_path, run_with_stubs):
+    export = tmp_path / "result.json"
+    _write_export(export, {"type": "personal_chat", "id": 1, "messages": [_message(1, REPORTS[0])]})
+
+    async def deliver(rows):
+        return len(rows)
+
+    async def scenario(server):
+        # Работающий бот держит очередь записи той же базы
+        bot_outbox = Outbox(main.DATABASE_FILE, deliver)
+        await bot_outbox.start()
+        try:
+            with pytest.raises(RuntimeError):
+                await _run_backfill(export)
+        finally:
+            await bot_outbox.stop()
+        assert not server.sheet_rows
+
+    run_with_stubs(scenario)
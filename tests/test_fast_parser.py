@@ -0,0 +1,87 @@
+from pathlib import Path
+
+import pytest
+
+from fast_parser import FastParser
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _read_lines(name: str) -> list:
+    text = (ROOT / name).read_text(encoding="utf-8")
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+@pytest.fixture(scope="module")
+def parser():
+    return FastParser(_read_lines("areas.txt"), _read_lines("operations.txt"), _read_lines("cultures.txt"))
+
+
+# Примеры из промпта: сообщение -> строки ответа YandexGPT
+PROMPT_EXAMPLES = [
+    ("Восход Посев кук-24/252га24%\nПредпосевная культ Под кук-94/490га46%",
+     ["00.00.00; Восход; Сев; Кукуруза товарная; 24; 252",
+      "00.00.00; Восход; Предпосевная культивация; Кукуруза товарная; 94; 490"]),
+    ("Пахота зяби под мн тр По Пу 26/488",
+     ["00.00.00; АОР; Пахота; Многолетние травы текущего года; 26; 488"]),
+    ("Предп культ под оз пш По Пу 91/1403 Отд 11 45/373 Отд 12 46/363",
+     ["00.00.00; АОР; Предпосевная культивация; Пшеница озимая товарная; 91; 1,403"]),
+    ("Внесение мин удобрений под оз пшеницу 2025 г ПУ Юг 149/7264 Отд 17-149/1443",
+     ["00.00.00; АОР; Внесение минеральных удобрений; Пшеница озимая товарная; 149; 7,264"]),
+    ("2-е диск сои под оз пш По Пу 82/1989 Отд 11 82/993",
+     ["00.00.00; АОР; Дискование 2-е; Пшеница озимая товарная; 82; 1,989"]),
+    ("диск сах св По Пу 70/1004 Отд 17 70/302",
+     ["00.00.00; АОР; Дискование; Свекла сахарная; 70; 1,004"]),
+    ("12.05\nВосход\nСев под сою 53/1816",
+     ["12.05; Восход; Сев; Соя товарная; 53; 1,816"]),
+    ("Мир\nСев\nпод подсолнечник: День - 50 га От начала - 1260 га (30%) Остаток - 2923 га",
+     ["00.00.00; Мир; Сев; Подсолнечник товарный; 50; 1,260"]),
+]
+
+
+@pytest.mark.parametrize("text, expected", PROMPT_EXAMPLES)
+def test_prompt_examples(parser, text, expected):
+    result = parser.parse(text)
+    assert result.lines == expected
+    assert result.unresolved == []
+    assert result.llm_input() == ""
+
+
+# Сообщение -> (строки, разобранные локально, None - место ответа модели; текст для YandexGPT)
+MIXED_MESSAGES = [
+    # Дату и участок задала разобранная строка - модель получает их заголовком
+    ("12.05 Восход Сев под сою 10/20\nБоронование под кук сил 35/120",
+     ["12.05; Восход; Сев; Соя товарная; 10; 20", None],
+     "12.05 Восход\nБоронование под кук сил 35/120"),
+    # Заголовки остаются перед строками, к которым относятся
+    ("Восход\nКультивация под ячмень 40/310\nМир\nБоронование под кук сил 35/120",
+     [None],
+     "Восход\nКультивация под ячмень 40/310\nМир\nБоронование под кук сил 35/120"),
+    # Нераспознанная строка без даты и участка передается как есть
+    ("Боронование под кук сил 35/120\nВосход Посев кук-24/252га24%",
+     [None, "00.00.00; Восход; Сев; Кукуруза товарная; 24; 252"],
+     "Боронование под кук сил 35/120"),
+    # Две культуры в строке: вторая пара га не теряется, строку разбирает модель
+    ("Мир Сев под кук 24/252, сою 10/50",
+     [None],
+     "Мир Сев под кук 24/252, сою 10/50"),
+    ("Мир Сев кук 24/252 сои 10/50",
+     [None],
+     "Мир Сев кук 24/252 сои 10/50"),
+]
+
+
+@pytest.mark.parametrize("text, lines, llm_input", MIXED_MESSAGES)
+def test_mixed_messages(parser, text, lines, llm_input):
+    result = parser.parse(text)
+    assert result.lines == lines
+    assert result.llm_input() == llm_input
+
+
+def test_merge_places_llm_answer(parser):
+    result = parser.parse("12.05 Восход Сев под сою 10/20\nБоронование под кук сил 35/120")
+    merged = result.merge("12.05; Восход; Боронование; Кукуруза на силос; 35; 120")
+    assert merged.split("\n") == [
+        "12.05; Восход; Сев; Соя товарная; 10; 20",
+        "12.05; Восход; Боронование; Кукуруза на силос; 35; 120",
+    ]
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+import main
+from http_client import LLMResult
+from model_router import ModelRouter
+
+FULL_ANSWER = "Восход;Пахота;Пшеница оз;24;252"
+
+
+@pytest.fixture
+def vocabulary(monkeypatch):
+    monkeypatch.setattr(main, "AREAS", ["Восход"], raising=False)
+    monkeypatch.setattr(main, "OPERATIONS", ["Пахота"], raising=False)
+    monkeypatch.setattr(main, "CULTURES", ["Пшеница оз"], raising=False)
+
+
+def _route(lite_answer: str):
+    """Модель, ответившая на запрос, и ее ответ"""
+    calls = []
+
+    async def complete(text, model_uri, max_tokens):
+        calls.append(model_uri)
+        return LLMResult(text=lite_answer if model_uri == "lite" else FULL_ANSWER)
+
+    router = ModelRouter(complete, "lite", "full", main.validate_expansion)
+    result = asyncio.run(router.expand("Восход пахота 24/252"))
+    return calls, result.text
+
+
+@pytest.mark.parametrize("lite_answer", [
+    "",
+    "Восход;—;—;24;252",
+    "Восход;Пахота;Пшеница оз;24;252\nВосход;-;-;-;-",
+])
+def test_flood_and_empty_lite_answers_are_accepted(vocabulary, lite_answer):
+    assert _route(lite_answer) == (["lite"], lite_answer)
+
+
+@pytest.mark.parametrize("lite_answer", [
+    "Восход;Пахота;24;252",
+    "Закат;Пахота;Пшеница оз;24;252",
+    "Восход;Пахота;Кукуруза;24;252",
+])
+def test_incomplete_or_unknown_lite_answers_escalate(vocabulary, lite_answer):
+    assert _route(lite_answer) == (["lite", "full"], FULL_ANSWER)
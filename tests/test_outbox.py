@@ -0,0 +1,149 @@
+import asyncio
+import sqlite3
+
+from outbox import Outbox
+from sheet_sink import RowsRejected
+
+
+def _rows(count: int) -> list:
+    return [(f"1:1:{i}", ["12/05/2026", "Восход", "Сев", "Соя товарная", str(i), str(i)]) for i in range(count)]
+
+
+async def _drain(outbox: Outbox, rows: list, timeout: float = 10):
+    await outbox.start()
+    await outbox.commit("1:1", rows, {"successful": len(rows)})
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while outbox.pending and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    await outbox.stop()
+
+
+def _states(db_path) -> dict:
+    with sqlite3.connect(db_path) as db:
+        return {row_key: (delivered, attempts)
+                for row_key, delivered, attempts in db.execute("SELECT row_key, delivered, attempts FROM sheet_outbox")}
+
+
+def test_outage_does_not_park_rows(tmp_path):
+    """Долгий сбой таблицы: строки ждут, а после восстановления записываются все"""
+    written = []
+    calls = 0
+
+    async def deliver(rows):
+        nonlocal calls
+        calls += 1
+        if calls <= 50:
+            return 0
+        written.extend(rows)
+        return len(rows)
+
+    db_path = tmp_path / "outbox.db"
+    outbox = Outbox(str(db_path), deliver, batch_size=8, retry_interval=0.001, max_retry_interval=0.002,
+                    max_attempts=3)
+    asyncio.run(_drain(outbox, _rows(20)))
+
+    assert calls > 50
+    assert len(written) == 20
+    assert outbox.parked == 0
+    assert set(_states(db_path).values()) == {(1, 0)}
+
+
+def test_transport_errors_do_not_park_rows(tmp_path):
+    calls = 0
+
+    async def deliver(rows):
+        nonlocal calls
+        calls += 1
+        if calls <= 20:
+            raise ConnectionError("сеть недоступна")
+        return len(rows)
+
+    db_path = tmp_path / "outbox.db"
+    outbox = Outbox(str(db_path), deliver, batch_size=8, retry_interval=0.001, max_retry_interval=0.002,
+                    max_attempts=3)
+    asyncio.run(_drain(outbox, _rows(5)))
+
+    assert outbox.parked == 0
+    assert set(_states(db_path).values()) == {(1, 0)}
+
+
+def test_rejected_row_is_parked_alone(tmp_path):
+    """Строку, которую таблица отвергает, откладывают одну, остальные записываются"""
+    written = []
+
+    async def deliver(rows):
+        if any(row[4] == "5" for row in rows):
+            raise RowsRejected("400 Invalid value")
+        written.extend(rows)
+        return len(rows)
+
+    db_path = tmp_path / "outbox.db"
+    outbox = Outbox(str(db_path), deliver, batch_size=8, retry_interval=0.001, max_attempts=3)
+    asyncio.run(_drain(outbox, _rows(20)))
+
+    states = _states(db_path)
+    assert outbox.parked == 1
+    assert states.pop("1:1:5")[0] == -1
+    assert len(written) == 19
+    assert set(states.values()) == {(1, 0)}
+
+
+def test_success_resets_attempts(tmp_path):
+    """Отказы, между которыми была успешная запись, не копятся до откладывания"""
+    calls = 0
+
+    async def deliver(rows):
+        nonlocal calls
+        calls += 1
+        if calls in (1, 3, 4):
+            raise RowsRejected("400 Invalid value")
+        return len(rows)
+
+    db_path = tmp_path / "outbox.db"
+    outbox = Outbox(str(db_path), deliver, batch_size=2, retry_interval=0.001, max_attempts=3)
+    asyncio.run(_drain(outbox, _rows(4)))
+
+    assert outbox.parked == 0
+    assert set(_states(db_path).values()) == {(1, 0)}
+
+
+def test_second_drainer_waits_for_lease(tmp_path):
+    """Два процесса с одной базой: каждую строку доставляет только один из них"""
+    delivered = []
+
+    async def deliver(rows):
+        await asyncio.sleep(0.01)
+        delivered.extend(tuple(row) for row in rows)
+        return len(rows)
+
+    async def wait_delivered(count: int):
+        deadline = asyncio.get_running_loop().time() + 5
+        while len(delivered) < count and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def run():
+        db_path = str(tmp_path / "outbox.db")
+        first = Outbox(db_path, deliver, batch_size=4, poll_interval=0.01, lease_interval=0.3)
+        second = Outbox(db_path, deliver, batch_size=4, poll_interval=0.01, lease_interval=0.3)
+        await first.start()
+        await second.start()
+        try:
+            assert first.draining and not second.draining
+            await first.commit("1:1", _rows(10))
+            await second.commit("1:2", [(f"1:2:{i}", ["13/05/2026", "Мир", "Сев", "Соя товарная", "1", str(i)])
+                                        for i in range(10)])
+            await wait_delivered(20)
+            await first.stop()
+            # После остановки первого процесса очередь доставляет второй
+            await second.commit("1:3", [(f"1:3:{i}", ["14/05/2026", "Мир", "Сев", "Соя товарная", "1", str(i)])
+                                        for i in range(5)])
+            await wait_delivered(25)
+            assert second.draining
+        finally:
+            await first.stop()
+            await second.stop()
+
+    asyncio.run(run())
+    assert len(delivered) == 25
+    assert len(set(delivered)) == 25
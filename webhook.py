@@ -0,0 +1,147 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import queue
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Консистентное хеширование: ключ всегда попадает на один и тот же узел,
+    а при изменении числа узлов переезжает лишь малая часть ключей"""
+
+    def __init__(self, nodes: int, replicas: int = 64):
+        points = sorted((_hash(f"{node}:{replica}"), node) for node in range(nodes) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key) -> int:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def update_chat_id(update: dict) -> int:
+    """Чат, к которому относится обновление Telegram; 0 - если чата нет"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+class WorkerPool:
+    """Процессы-обработчики обновлений, у каждого своя очередь.
+
+    Обновления одного чата всегда уходят в один процесс и ставятся в его
+    конвейер в порядке поступления. Упавший процесс перезапускается с той же
+    очередью, так что принятые, но не взятые им обновления не теряются.
+    """
+
+    def __init__(self, context, target, workers: int, queue_size: int = 1000, args: tuple = (),
+                 check_interval: float = 5):
+        self.context = context
+        self.target = target
+        self.workers = workers
+        self.args = args
+        self.check_interval = check_interval
+        self.ring = HashRing(workers)
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+        self._task = None
+
+    def _spawn(self, index: int):
+        process = self.context.Process(
+            target=self.target, args=(index, self.queues[index], self.workers) + self.args,
+            name=f"agro-worker-{index}", daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self, timeout: float = 60):
+        """Просит процессы дообработать очереди и ждет их завершения"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for updates in self.queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился за {timeout} с, останавливаем")
+                process.terminate()
+
+    def dispatch(self, update: dict) -> bool:
+        """Передает обновление процессу его чата; False - если очередь процесса заполнена"""
+        index = self.ring.node(update_chat_id(update))
+        try:
+            self.queues[index].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    def depths(self) -> dict:
+        depths = {}
+        for index, updates in enumerate(self.queues):
+            try:
+                depths[index] = updates.qsize()
+            except NotImplementedError:
+                depths[index] = 0
+        return depths
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f"Процесс {process.name} завершился с кодом {process.exitcode}, перезапускаем")
+                    self._spawn(index)
+
+
+async def start_webhook_server(pool: WorkerPool, host: str, port: int, path: str, secret: str = None,
+                               intercept=None):
+    """Принимает обновления Telegram и сразу отвечает; обработка идет в процессах пула.
+
+    intercept(update) может вернуть вызов Bot API (словарь с полем method), которым
+    Telegram ответит сам; такое обновление в процессы пула не передается.
+    """
+    async def handle(request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if intercept is not None:
+            reply = intercept(update)
+            if reply is not None:
+                return web.json_response(reply)
+        if not pool.dispatch(update):
+            # Telegram повторит доставку позже
+            logger.warning("Очередь обработчика заполнена, обновление отклонено")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Вебхук принимает обновления на http://{host}:{port}{path}, процессов: {pool.workers}")
+    return runner